@@ -0,0 +1,320 @@
+"""Local stand-in for fantia.jp and its media CDN, serving synthetic fanclubs, posts and files."""
+
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import random
+import re
+import threading
+import time
+
+API_HOST = "127.0.0.1"
+CDN_HOST = "localhost"
+
+POSTS_PER_PAGE = 20
+TIMELINE_PER_PAGE = 24
+POST_ID_STRIDE = 1000000
+BASE_TIMESTAMP = 1704034800 # 2024-01-01 00:00 JST
+LAST_MODIFIED = formatdate(BASE_TIMESTAMP, usegmt=True)
+CSRF_TOKEN = "benchmark-csrf-token"
+PATTERN = bytes(range(256)) * 4096 # 1 MB of deterministic media content
+SEND_CHUNK_SIZE = 64 * 1024
+
+MEDIA_PATH_RE = re.compile(r"^/media/(\d+)/(\d+)/([^/]+)$")
+CONTENT_TYPES = {".jpg": "image/jpeg", ".png": "image/png", ".bin": "application/octet-stream"}
+
+
+class Fanclub:
+    """Synthetic fanclub whose posts each carry the same number of photos and files."""
+    def __init__(self, id, post_count, photos_per_post=1, photo_size=64 * 1024, files_per_post=0, file_size=1024 * 1024):
+        self.id = id
+        self.post_count = post_count
+        self.photos_per_post = photos_per_post
+        self.photo_size = photo_size
+        self.files_per_post = files_per_post
+        self.file_size = file_size
+
+    def post_id(self, index):
+        return self.id * POST_ID_STRIDE + index
+
+    def post_ids(self):
+        """Return post IDs newest first, as the fanclub pages list them."""
+        return [self.post_id(index) for index in range(self.post_count, 0, -1)]
+
+
+class MockFantia:
+    """Synthetic site contents plus the fault injection settings applied to every response."""
+    def __init__(self, fanclubs, latency=0.0, bandwidth=0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.fanclubs = {fanclub.id: fanclub for fanclub in fanclubs}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.port = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+            self.throttled = 0
+
+    def counters(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "bytes_sent": self.bytes_sent, "throttled": self.throttled}
+
+    def count(self, host, status_code, size):
+        with self.lock:
+            key = "{} {}".format("api" if host == API_HOST else "cdn", status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_sent += size
+
+    def should_throttle(self):
+        if not self.throttle_rate:
+            return False
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+            return throttled
+
+    def base_url(self, host):
+        return "http://{}:{}".format(host, self.port)
+
+    def find_post(self, post_id):
+        fanclub = self.fanclubs.get(post_id // POST_ID_STRIDE)
+        index = post_id % POST_ID_STRIDE
+        if fanclub is None or not 1 <= index <= fanclub.post_count:
+            return None, None
+        return fanclub, index
+
+    # Payloads
+
+    def fanclub_json(self, fanclub):
+        return {
+            "fanclub": {
+                "id": fanclub.id,
+                "creator_name": "creator{}".format(fanclub.id),
+                "cover": {"original": "{}/media/{}/{}/cover.jpg".format(self.base_url(CDN_HOST), 256 * 1024, fanclub.id)},
+                "icon": {"original": "{}/media/{}/{}/icon.png".format(self.base_url(CDN_HOST), 32 * 1024, fanclub.id)},
+                "background": None
+            }
+        }
+
+    def post_json(self, fanclub, index):
+        post_id = fanclub.post_id(index)
+        posted_at = BASE_TIMESTAMP + index * 3600
+        post_contents = []
+        if fanclub.photos_per_post:
+            post_contents.append(self.content_json(post_id, post_id * 10 + 1, {
+                "category": "photo_gallery",
+                "post_content_photos": [
+                    {"url": {"original": "{}/media/{}/{}/{}.jpg".format(self.base_url(CDN_HOST), fanclub.photo_size, post_id, photo)}}
+                    for photo in range(fanclub.photos_per_post)
+                ]
+            }))
+        for file_index in range(fanclub.files_per_post):
+            content_id = post_id * 10 + 2 + file_index
+            post_contents.append(self.content_json(post_id, content_id, {
+                "category": "file",
+                "filename": "file{}.bin".format(file_index),
+                "download_uri": "/posts/{}/download/{}".format(post_id, content_id)
+            }))
+        return {
+            "post": {
+                "id": post_id,
+                "title": "Post {}".format(post_id),
+                "comment": "",
+                "posted_at": formatdate(posted_at, localtime=False),
+                "converted_at": None,
+                "thumb": {"original": "{}/media/{}/{}/thumb.jpg".format(self.base_url(CDN_HOST), 16 * 1024, post_id)},
+                "fanclub": {"id": fanclub.id, "creator_name": "creator{}".format(fanclub.id)},
+                "post_contents": post_contents
+            }
+        }
+
+    def content_json(self, post_id, content_id, fields):
+        content = {
+            "id": content_id,
+            "title": "Content {}".format(content_id),
+            "visible_status": "visible",
+            "comment": "",
+            "parent_post": {"url": "/posts/{}".format(post_id), "title": "Post {}".format(post_id)},
+            "foreign_plan_price": 0,
+            "currency_code": "JPY"
+        }
+        content.update(fields)
+        return content
+
+    def fanclub_posts_html(self, fanclub, page):
+        post_ids = fanclub.post_ids()[(page - 1) * POSTS_PER_PAGE:page * POSTS_PER_PAGE]
+        return self.page_html("<div class=\"row\">{}</div>".format("".join(self.post_card_html(post_id) for post_id in post_ids)))
+
+    def post_card_html(self, post_id):
+        """Render a listing entry with roughly the markup of a real one, so parse times are representative."""
+        posted_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(BASE_TIMESTAMP + (post_id % POST_ID_STRIDE) * 3600))
+        # Some real entries carry the date directly in .post-date
+        date_html = posted_at if post_id % 7 == 0 else "<span class=\"mr-5\">{}</span><span class=\"post-comment\"><i class=\"fa fa-comment\"></i> 3</span>".format(posted_at)
+        return (
+            "<div class=\"col-6 col-lg-3\"><div class=\"post\">"
+            "<a class=\"link-block\" href=\"/posts/{0}\">"
+            "<div class=\"post-thumbnail bg-gray\"><img alt=\"Post {0}\" class=\"img-default\" loading=\"lazy\" src=\"/media/thumb/{0}.jpg\"></div>"
+            "<div class=\"post-inner\"><h3 class=\"post-title\">Post {0} &amp; more</h3>"
+            "<div class=\"post-date\">{1}</div>"
+            "<div class=\"post-tags\"><span class=\"label label-default\">#tag</span> <span class=\"label label-default\">#benchmark</span></div></div>"
+            "</a><div class=\"post-footer\"><button class=\"btn btn-like\" data-post-id=\"{0}\"><i class=\"fa fa-heart\"></i> 12</button></div>"
+            "</div></div>"
+        ).format(post_id, date_html)
+
+    def paid_plans_html(self, page):
+        fanclub_ids = sorted(self.fanclubs) if page == 1 else []
+        plans = "".join(
+            "<div class=\"mb-5-children\"><div class=\"fanclub-name\"><a href=\"/fanclubs/{0}\">Fanclub {0}</a></div>"
+            "<div class=\"plan-name\"><a href=\"/fanclubs/{0}/plans\">Plan</a></div></div>".format(fanclub_id)
+            for fanclub_id in fanclub_ids
+        )
+        return self.page_html(plans)
+
+    def page_html(self, body):
+        return (
+            "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><meta name=\"csrf-token\" content=\"{}\"><title>Fantia</title>"
+            "<script>window.dataLayer = window.dataLayer || []; function gtag() {{ dataLayer.push(arguments); }}</script></head>"
+            "<body><header class=\"navbar\"><nav><ul>{}</ul></nav></header><main class=\"container\">{}</main>"
+            "<footer><p>&copy; Fantia</p></footer></body></html>"
+        ).format(CSRF_TOKEN, "".join("<li><a href=\"/nav/{0}\">Link {0}</a></li>".format(index) for index in range(40)), body)
+
+    def timeline_json(self, page):
+        post_ids = sorted((post_id for fanclub in self.fanclubs.values() for post_id in fanclub.post_ids()), key=lambda post_id: post_id % POST_ID_STRIDE, reverse=True)
+        page_post_ids = post_ids[(page - 1) * TIMELINE_PER_PAGE:page * TIMELINE_PER_PAGE]
+        return {"posts": [{"id": post_id} for post_id in page_post_ids], "has_next": page * TIMELINE_PER_PAGE < len(post_ids)}
+
+
+class MockFantiaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockFantia/1.0"
+    # Headers and small bodies are written separately; without this, delayed ACKs stall every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def site(self):
+        return self.server.site
+
+    def do_GET(self):
+        if self.site.latency:
+            time.sleep(self.site.latency)
+        host = (self.headers.get("Host") or API_HOST).rsplit(":", 1)[0]
+        if self.site.should_throttle():
+            self.send_body(host, 429, b"", "text/plain", {"Retry-After": str(self.site.retry_after)})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+        media_match = MEDIA_PATH_RE.match(url.path)
+        parts = url.path.strip("/").split("/")
+
+        if media_match:
+            self.send_media(host, int(media_match.group(1)), media_match.group(3))
+        elif host != API_HOST:
+            self.send_body(host, 404, b"", "text/plain")
+        elif url.path == "/api/v1/me":
+            self.send_json(host, {"id": 1})
+        elif url.path == "/api/v1/me/fanclubs":
+            self.send_json(host, {"fanclub_ids": sorted(self.site.fanclubs)})
+        elif url.path == "/api/v1/me/timelines/posts":
+            self.send_json(host, self.site.timeline_json(page))
+        elif parts[:3] == ["api", "v1", "fanclubs"] and len(parts) == 4 and int(parts[3]) in self.site.fanclubs:
+            self.send_json(host, self.site.fanclub_json(self.site.fanclubs[int(parts[3])]))
+        elif parts[:3] == ["api", "v1", "posts"] and len(parts) == 4:
+            fanclub, index = self.site.find_post(int(parts[3]))
+            if fanclub is None:
+                self.send_body(host, 404, b"", "text/plain")
+            else:
+                self.send_json(host, self.site.post_json(fanclub, index))
+        elif parts[0] == "fanclubs" and len(parts) == 3 and parts[2] == "posts" and int(parts[1]) in self.site.fanclubs:
+            self.send_html(host, self.site.fanclub_posts_html(self.site.fanclubs[int(parts[1])], page))
+        elif url.path == "/mypage/users/plans":
+            self.send_html(host, self.site.paid_plans_html(page))
+        elif parts[0] == "posts" and len(parts) == 4 and parts[2] == "download":
+            # Attachments redirect from the main site to the CDN like the real download endpoint
+            fanclub, _ = self.site.find_post(int(parts[1]))
+            location = "{}/media/{}/{}/file{}.bin".format(self.site.base_url(CDN_HOST), fanclub.file_size, parts[1], int(parts[3]) - int(parts[1]) * 10 - 2)
+            self.send_body(host, 302, b"", "text/plain", {"Location": location})
+        elif parts[0] == "posts" and len(parts) == 2:
+            self.send_html(host, self.site.page_html(""))
+        else:
+            self.send_body(host, 404, b"", "text/plain")
+
+    def send_json(self, host, payload):
+        self.send_body(host, 200, json.dumps(payload).encode("utf-8"), "application/json; charset=utf-8")
+
+    def send_html(self, host, html):
+        self.send_body(host, 200, html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def send_body(self, host, status_code, body, content_type, headers=None):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.site.count(host, status_code, len(body))
+
+    def send_media(self, host, size, name):
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and parsedate_to_datetime(if_modified_since).timestamp() >= BASE_TIMESTAMP:
+            self.send_body(host, 304, b"", "text/plain", {"Last-Modified": LAST_MODIFIED})
+            return
+
+        start, end = 0, size - 1
+        status_code = 200
+        range_match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2)), size - 1) if range_match.group(2) else size - 1
+            status_code = 206
+        extension = name[name.rfind("."):] if "." in name else ""
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", CONTENT_TYPES.get(extension, "application/octet-stream"))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("ETag", "\"{}-{}\"".format(size, name))
+        if status_code == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.end_headers()
+
+        position = start
+        started = time.monotonic()
+        while position <= end:
+            offset = position % len(PATTERN)
+            chunk = PATTERN[offset:offset + min(SEND_CHUNK_SIZE, end + 1 - position)]
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                break
+            position += len(chunk)
+            if self.site.bandwidth:
+                # Pace each connection to the configured bandwidth
+                ahead = (position - start) / self.site.bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.site.count(host, status_code, position - start)
+
+
+def start_server(site, port=0):
+    """Serve the site on 127.0.0.1 (main site) and localhost (CDN) from a background thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockFantiaHandler)
+    server.daemon_threads = True
+    server.site = site
+    site.port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, name="mock-fantia", daemon=True).start()
+    return server
@@ -0,0 +1,48 @@
+"""Check that every listing page parser backend returns the same results as html.parser, and time each one per page."""
+
+import math
+import os
+import time
+
+from .mock_server import POSTS_PER_PAGE
+
+PARSE_ROUNDS = 5
+
+
+def listing_documents(site, max_pages, saved_pages=None):
+    """Return (method, name, html) for the mock site's listing pages plus any saved real pages.
+    Saved pages are parsed as paid plans pages if their filename contains "plans" and as fanclub posts pages otherwise."""
+    documents = []
+    for fanclub in site.fanclubs.values():
+        for page in range(1, min(math.ceil(fanclub.post_count / POSTS_PER_PAGE), max_pages) + 1):
+            documents.append(("fanclub_posts", "fanclub {} page {}".format(fanclub.id, page), site.fanclub_posts_html(fanclub, page)))
+    documents.append(("paid_fanclub_ids", "paid plans page 1", site.paid_plans_html(1)))
+    if saved_pages:
+        for filename in sorted(os.listdir(saved_pages)):
+            if not filename.endswith(".html"):
+                continue
+            with open(os.path.join(saved_pages, filename), encoding="utf-8") as file:
+                documents.append(("paid_fanclub_ids" if "plans" in filename else "fanclub_posts", filename, file.read()))
+    return documents
+
+
+def benchmark_parsers(parsers, documents):
+    """Parse every document with each available backend, returning per-page timings and any results differing from html.parser."""
+    reference = parsers.get_parser(parsers.SoupParser.name)
+    expected = [getattr(reference, method)(html) for method, _, html in documents]
+    results = {}
+    for name in sorted(parsers.PARSERS):
+        parser = parsers.get_parser(name)
+        mismatches = [document_name for (method, document_name, html), reference_result in zip(documents, expected) if getattr(parser, method)(html) != reference_result]
+        timings = {}
+        for method, _, html in documents:
+            started = time.perf_counter()
+            for _ in range(PARSE_ROUNDS):
+                getattr(parser, method)(html)
+            timings.setdefault(method, []).append((time.perf_counter() - started) / PARSE_ROUNDS)
+        results[name] = {
+            "pages": len(documents),
+            "ms_per_page": {method: round(1000 * sum(seconds) / len(seconds), 3) for method, seconds in timings.items()},
+            "mismatches": mismatches
+        }
+    return results
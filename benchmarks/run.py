@@ -0,0 +1,213 @@
+"""Run end-to-end download scenarios against the local mock server and report machine-readable results.
+
+    python -m benchmarks.run [--scenario NAME ...] [--scale 0.1] [-j 4] [--output results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from .mock_server import API_HOST, Fanclub, MockFantia, start_server
+from .parsing import benchmark_parsers, listing_documents
+
+MB = 1024 * 1024
+
+# Each scenario lists the fanclubs the mock site serves and what the downloader is asked to fetch.
+# Warm scenarios run once untimed to populate the output directory and database, then again timed.
+SCENARIOS = {
+    "huge_fanclub": {
+        "fanclubs": [{"id": 1, "post_count": 2000, "photos_per_post": 1, "photo_size": 32 * 1024}],
+        "target": ("fanclub", 1)
+    },
+    "photo_gallery": {
+        "fanclubs": [{"id": 2, "post_count": 1, "photos_per_post": 500, "photo_size": 256 * 1024}],
+        "target": ("post", 2 * 1000000 + 1)
+    },
+    "large_file": {
+        "fanclubs": [{"id": 3, "post_count": 1, "photos_per_post": 0, "files_per_post": 1, "file_size": 2048 * MB}],
+        "target": ("post", 3 * 1000000 + 1)
+    },
+    "warm_rerun": {
+        "fanclubs": [{"id": 4, "post_count": 500, "photos_per_post": 4, "photo_size": 64 * 1024}],
+        "target": ("fanclub", 4),
+        "db": True,
+        "warm": True
+    }
+}
+
+
+def scaled_fanclubs(scenario, scale):
+    fanclubs = []
+    for fanclub in scenario["fanclubs"]:
+        fanclub = dict(fanclub)
+        fanclub["post_count"] = max(1, int(fanclub["post_count"] * scale)) if fanclub["post_count"] > 1 else 1
+        if fanclub.get("photos_per_post", 0) > 1:
+            fanclub["photos_per_post"] = max(1, int(fanclub["photos_per_post"] * scale))
+        if "file_size" in fanclub:
+            fanclub["file_size"] = max(MB, int(fanclub["file_size"] * scale))
+        fanclubs.append(fanclub)
+    return fanclubs
+
+
+def import_package():
+    import fantiadl.models
+    return fantiadl
+
+
+def import_fantiadl(base_url):
+    """Import the package with its URL constants pointed at the mock server."""
+    package = import_package()
+    models = package.models
+    ratelimit = package.ratelimit
+    ratelimit.API_HOSTS.clear()
+    ratelimit.API_HOSTS.add(API_HOST)
+    models.DOMAIN = API_HOST
+    models.BASE_URL = base_url + "/"
+    models.ME_API = base_url + "/api/v1/me"
+    models.FANCLUB_API = base_url + "/api/v1/fanclubs/{}"
+    models.FANCLUBS_FOLLOWING_API = base_url + "/api/v1/me/fanclubs"
+    models.FANCLUBS_PAID_HTML = base_url + "/mypage/users/plans?type=not_free&page={}"
+    models.FANCLUB_POSTS_HTML = base_url + "/fanclubs/{}/posts?page={}"
+    models.POST_API = base_url + "/api/v1/posts/{}"
+    models.POST_URL = base_url + "/posts/{}"
+    models.POSTS_URL = base_url + "/posts"
+    models.TIMELINES_API = base_url + "/api/v1/me/timelines/posts?page={}&per={}"
+    return models
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / MB if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def run_scenario(base_url, scenario, directory, options, results):
+    """Run a scenario in this process and put its measurements on the results queue."""
+    models = import_fantiadl(base_url)
+    db_path = os.path.join(directory, "fantiadl.db") if scenario.get("db") else None
+    started = time.monotonic()
+    downloader = models.FantiaDownloader(
+        session_arg="benchmark",
+        directory=os.path.join(directory, "output"),
+        quiet=True,
+        db_path=db_path,
+        download_thumb=True,
+        jobs=options["jobs"],
+        segments=options["segments"],
+        api_rate=options["api_rate"],
+        api_concurrency=options["api_concurrency"],
+        fanclub_jobs=options["fanclub_jobs"],
+        prefetch_pages=options["prefetch_pages"]
+    )
+    kind, target = scenario["target"]
+    if kind == "fanclub":
+        downloader.download_fanclub(models.FantiaClub(target))
+    else:
+        downloader.download_post(target)
+    downloader.pool.shutdown()
+    downloader.db.close()
+    wall_seconds = time.monotonic() - started
+
+    metrics = downloader.metrics.summary()
+    request_count = sum(request["count"] for request in metrics["requests"])
+    results.put({
+        "wall_seconds": round(wall_seconds, 3),
+        "requests": request_count,
+        "requests_per_second": round(request_count / wall_seconds, 1),
+        "downloads": metrics["downloads"]["completed"],
+        "skips": metrics["skips"],
+        "media_bytes": metrics["download_bytes"],
+        "mb_per_second": round(metrics["download_bytes"] / MB / wall_seconds, 2),
+        "retries": sum(metrics["retries"].values()),
+        "db_seconds": metrics["db_seconds"],
+        "peak_rss_mb": peak_rss_mb()
+    })
+
+
+def run_in_subprocess(base_url, scenario, directory, options):
+    """Run a scenario in a fresh process so peak RSS covers that scenario alone."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_scenario, args=(base_url, scenario, directory, options, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Scenario process exited with code {}".format(process.exitcode))
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fantiadl against a local mock Fantia server.")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=sorted(SCENARIOS), help="scenario to run (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply post counts, gallery sizes and file sizes (default: 1.0)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency added to every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="per-connection bandwidth limit in MB/s (default: unlimited)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429 responses (default: 1)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="fantiadl --jobs")
+    parser.add_argument("--segments", type=int, default=1, help="fantiadl --segments")
+    parser.add_argument("--api-rate", type=float, default=0, help="fantiadl --api-rate (default: unlimited)")
+    parser.add_argument("--api-concurrency", type=int, default=2, help="fantiadl --api-concurrency")
+    parser.add_argument("--fanclub-jobs", type=int, default=1, help="fantiadl --fanclub-jobs")
+    parser.add_argument("--prefetch-pages", type=int, default=0, help="fantiadl --prefetch-pages")
+    parser.add_argument("--work-dir", help="directory for downloaded files (default: a temporary directory)")
+    parser.add_argument("--parse-pages", type=int, default=20, help="listing pages per fanclub to parse with each HTML parser backend (default: 20)")
+    parser.add_argument("--saved-pages", metavar="DIRECTORY", help="also check parser backends against saved .html listing pages in DIRECTORY")
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in ("jobs", "segments", "api_rate", "api_concurrency", "fanclub_jobs", "prefetch_pages")}
+    report = {
+        "fantiadl_version": import_package().__version__.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+        "config": dict(options, scale=args.scale, latency=args.latency, bandwidth=args.bandwidth, throttle_rate=args.throttle_rate),
+        "results": []
+    }
+
+    parse_site = MockFantia([Fanclub(**fanclub) for scenario in SCENARIOS.values() for fanclub in scaled_fanclubs(scenario, args.scale)])
+    report["parsing"] = benchmark_parsers(import_package().parsers, listing_documents(parse_site, args.parse_pages, args.saved_pages))
+
+    for name in args.scenarios or sorted(SCENARIOS):
+        scenario = SCENARIOS[name]
+        site = MockFantia([Fanclub(**fanclub) for fanclub in scaled_fanclubs(scenario, args.scale)], latency=args.latency, bandwidth=args.bandwidth * MB, throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+        server = start_server(site)
+        base_url = site.base_url(API_HOST)
+        directory = tempfile.mkdtemp(prefix="fantiadl-bench-", dir=args.work_dir)
+        try:
+            if scenario.get("warm"):
+                run_in_subprocess(base_url, scenario, directory, options)
+                site.reset_counters()
+            sys.stderr.write("Running {}...\n".format(name))
+            result = run_in_subprocess(base_url, scenario, directory, options)
+            server_counters = site.counters()
+            result.update({"scenario": name, "server_requests": server_counters["requests"], "server_bytes": server_counters["bytes_sent"], "throttled": server_counters["throttled"]})
+            report["results"].append(result)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    if any(result["mismatches"] for result in report["parsing"].values()):
+        sys.exit("HTML parser backends disagree on some pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
 from .fantiadl import cli
 
-cli()
\ No newline at end of file
+if __name__ == "__main__":
+    cli()
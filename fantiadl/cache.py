@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+EVICTION_TARGET = 0.9 # fraction of max_bytes the cache is trimmed to once full, so a full cache isn't rescanned on every store
+
+
+class HttpCache:
+    """On-disk cache of response bodies keyed by URL and revalidated with ETag/Last-Modified.
+    Entries older than the TTL are discarded, and the least recently used entries are evicted once the cache grows past max_bytes."""
+    def __init__(self, directory, ttl=60 * 60 * 24 * 30, max_bytes=1024 * 1024 * 256):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory))
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + ".json"), os.path.join(self.directory, key + ".body")
+
+    def load(self, url):
+        """Return the cached metadata and body for a URL, discarding expired entries."""
+        metadata_path, body_path = self.paths(url)
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as file:
+                metadata = json.load(file)
+            with open(body_path, "rb") as file:
+                body = file.read()
+        except (OSError, ValueError):
+            return None, None
+        if metadata.get("url") != url or time.time() - metadata["stored_at"] > self.ttl:
+            self.remove(metadata_path, body_path)
+            return None, None
+        return metadata, body
+
+    def store(self, url, response):
+        """Store a response's body along with its validators."""
+        metadata = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.encoding,
+            "stored_at": time.time()
+        }
+        metadata_path, body_path = self.paths(url)
+        with self.lock:
+            self.remove(metadata_path, body_path)
+            self.write(body_path, "wb", response.content)
+            self.write(metadata_path, "w", json.dumps(metadata))
+            self.evict()
+
+    def refresh(self, url, metadata, response):
+        """Restart a revalidated entry's TTL, picking up any validators the 304 response updated."""
+        metadata = dict(metadata, stored_at=time.time())
+        for key, header in (("etag", "ETag"), ("last_modified", "Last-Modified")):
+            if response.headers.get(header):
+                metadata[key] = response.headers[header]
+        metadata_path, body_path = self.paths(url)
+        with self.lock:
+            self.remove(metadata_path)
+            self.write(metadata_path, "w", json.dumps(metadata))
+        os.utime(body_path) # Mark as recently used
+
+    def write(self, path, mode, data):
+        with open(path + ".tmp", mode) as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+        self.size += os.path.getsize(path)
+
+    def remove(self, *paths):
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove the least recently used entries once the cache outgrows max_bytes, until it's back under the eviction target."""
+        if self.size <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICTION_TARGET
+        bodies = [os.path.join(self.directory, filename) for filename in os.listdir(self.directory) if filename.endswith(".body")]
+        bodies.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for body_path in bodies:
+            if self.size <= target:
+                break
+            self.remove(body_path[:-len(".body")] + ".json", body_path)
+
+    def get(self, session, url, headers=None):
+        """Perform a conditional GET, answering 304 responses from the cache.
+        The returned response looks like a 200 response carrying the cached body when served from the cache."""
+        metadata, body = self.load(url)
+        request_headers = dict(headers or {})
+        if metadata:
+            if metadata["etag"]:
+                request_headers["If-None-Match"] = metadata["etag"]
+            if metadata["last_modified"]:
+                request_headers["If-Modified-Since"] = metadata["last_modified"]
+
+        response = session.get(url, headers=request_headers)
+        if response.status_code == 304 and metadata:
+            with self.lock:
+                self.hits += 1
+                self.bytes_saved += len(body)
+            self.refresh(url, metadata, response)
+            response.status_code = 200
+            response._content = body
+            response.encoding = metadata["encoding"]
+            return response
+
+        with self.lock:
+            self.misses += 1
+        if response.ok and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+            self.store(url, response)
+        return response
+
+    def summary(self):
+        return "HTTP cache: {} revalidated, {} fetched, {:.1f} MB not transferred\n".format(self.hits, self.misses, self.bytes_saved / (1024 * 1024))
@@ -1,39 +1,275 @@
+import atexit
+import hashlib
+import math
+import sys
+import threading
 import time
 import sqlite3
 
+from .profiling import Profiler
+
+COMMIT_POLICIES = ("post", "writes", "seconds")
+
+# Approximate cost of one 64-bit key held in a Python set, including hash table overhead
+SET_ENTRY_BYTES = 80
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+# Each entry migrates the schema from the previous version. Databases created before versioning was
+# introduced start at version 0; their existing tables are left untouched by CREATE ... IF NOT EXISTS.
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, timestamp INTEGER)",
+        "CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, title TEXT, fanclub INTEGER, posted_at INTEGER, converted_at INTEGER, download_complete INTEGER, timestamp INTEGER)",
+        "CREATE TABLE IF NOT EXISTS post_contents (id INTEGER PRIMARY KEY, parent_post INTEGER, title TEXT, category TEXT, price INTEGER, currency TEXT, timestamp INTEGER, FOREIGN KEY(parent_post) REFERENCES posts(id))",
+        "CREATE TABLE IF NOT EXISTS fanclub_sync (fanclub INTEGER PRIMARY KEY, last_post_id INTEGER, last_posted_at INTEGER, runs_since_full_scan INTEGER, timestamp INTEGER)",
+        "CREATE TABLE IF NOT EXISTS url_extensions (url TEXT PRIMARY KEY, extension TEXT, timestamp INTEGER)"
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS post_contents_parent_post ON post_contents(parent_post)",
+        "CREATE INDEX IF NOT EXISTS posts_fanclub ON posts(fanclub)"
+    ],
+    [
+        "ALTER TABLE urls ADD COLUMN path TEXT",
+        "ALTER TABLE urls ADD COLUMN size INTEGER",
+        "ALTER TABLE urls ADD COLUMN hash TEXT",
+        "ALTER TABLE urls ADD COLUMN post_content INTEGER"
+    ],
+    [
+        # Work queue items move from pending to in_progress, then to done or failed
+        "CREATE TABLE IF NOT EXISTS work_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, key TEXT, post INTEGER, post_content INTEGER, filepath TEXT, use_server_filename INTEGER, append_server_extension INTEGER, state TEXT, attempts INTEGER, error TEXT, timestamp INTEGER, UNIQUE(kind, key))",
+        "CREATE INDEX IF NOT EXISTS work_queue_state ON work_queue(kind, state)",
+        "CREATE TABLE IF NOT EXISTS queued_post_contents (id INTEGER PRIMARY KEY, parent_post INTEGER, title TEXT, category TEXT, price INTEGER, currency TEXT, timestamp INTEGER)"
+    ]
+]
+
+# Rows from a shard's database are merged into the target without duplicating downloads.
+# Posts and sync watermarks keep whichever copy was updated most recently.
+MERGE_STATEMENTS = [
+    "INSERT OR IGNORE INTO urls SELECT * FROM shard.urls",
+    "INSERT OR REPLACE INTO posts SELECT * FROM shard.posts AS shard_post WHERE NOT EXISTS (SELECT 1 FROM posts WHERE posts.id = shard_post.id AND posts.timestamp >= shard_post.timestamp)",
+    "INSERT OR IGNORE INTO post_contents SELECT * FROM shard.post_contents",
+    "INSERT OR REPLACE INTO fanclub_sync SELECT * FROM shard.fanclub_sync AS shard_sync WHERE NOT EXISTS (SELECT 1 FROM fanclub_sync WHERE fanclub_sync.fanclub = shard_sync.fanclub AND fanclub_sync.timestamp >= shard_sync.timestamp)",
+    "INSERT OR IGNORE INTO url_extensions SELECT * FROM shard.url_extensions"
+]
+
+class KeyIndex:
+    """Exact in-memory index of 64-bit key hashes."""
+    exact = True
+
+    def __init__(self):
+        self.keys = set()
+
+    def add(self, key):
+        self.keys.add(hash_key(key))
+
+    def __contains__(self, key):
+        return hash_key(key) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def memory_usage(self):
+        return sys.getsizeof(self.keys) + len(self.keys) * sys.getsizeof(1 << 62)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter. Membership is probabilistic and must be confirmed against the database."""
+    exact = False
+
+    def __init__(self, capacity, max_bytes):
+        ideal_bits = math.ceil(-max(capacity, 1) * math.log(BLOOM_FALSE_POSITIVE_RATE) / (math.log(2) ** 2))
+        self.size = max(8, min(ideal_bits, max_bytes * 8))
+        self.hash_count = max(1, round(self.size / max(capacity, 1) * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def memory_usage(self):
+        return sys.getsizeof(self.bits)
+
+
+def hash_key(key):
+    """Reduce a URL or ID to a 64-bit integer."""
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "little")
+
+
 class FantiaDlDatabase:
-    def __init__(self, db_path):
+    def __init__(self, db_path, commit_policy="post", commit_interval=100, metrics=None, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler or Profiler()
+        # Downloads finish on worker threads, so every statement is serialized through the lock
+        self.lock = threading.RLock()
+        self.url_index = None
+        self.post_content_index = None
         if db_path is None:
             self.conn = None
             return
 
-        self.conn = sqlite3.connect(db_path)
+        if commit_policy not in COMMIT_POLICIES:
+            raise ValueError("Unknown commit policy: {}".format(commit_policy))
+        self.commit_policy = commit_policy
+        self.commit_interval = commit_interval
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
 
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, timestamp INTEGER)")
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, title TEXT, fanclub INTEGER, posted_at INTEGER, converted_at INTEGER, download_complete INTEGER, timestamp INTEGER)")
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS post_contents (id INTEGER PRIMARY KEY, parent_post INTEGER, title TEXT, category TEXT, price INTEGER, currency TEXT, timestamp INTEGER, FOREIGN KEY(parent_post) REFERENCES posts(id))")
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
 
-        self.conn.commit()
+        # Writes are batched, so make sure anything pending is flushed when the interpreter exits
+        atexit.register(self.close)
 
     def __del__(self):
-        if self.conn is not None:
+        self.close()
+
+    def migrate(self):
+        """Bring the schema up to date, recording the applied version."""
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+        row = self.cursor.execute("SELECT version FROM schema_version").fetchone()
+        version = row["version"] if row else 0
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                self.cursor.execute(statement)
+        if row:
+            self.cursor.execute("UPDATE schema_version SET version = ?", (len(MIGRATIONS),))
+        else:
+            self.cursor.execute("INSERT INTO schema_version VALUES (?)", (len(MIGRATIONS),))
+        self.conn.commit()
+
+    def commit(self):
+        """Commit any pending writes."""
+        if getattr(self, "conn", None) is None:
+            return
+        with self.lock:
+            if self.pending_writes:
+                started = time.perf_counter()
+                with self.profiler.phase("db"):
+                    self.conn.commit()
+                self.record_time(started)
+                self.pending_writes = 0
+            self.last_commit = time.monotonic()
+
+    def checkpoint(self):
+        """Mark the end of a post, committing if the commit policy is per post."""
+        if getattr(self, "conn", None) is not None and self.commit_policy == "post":
+            self.commit()
+
+    def close(self):
+        """Flush pending writes and close the connection."""
+        if getattr(self, "conn", None) is None:
+            return
+        with self.lock:
+            self.commit()
             self.conn.close()
+            self.conn = None
+
+    def merge(self, db_path):
+        """Merge the downloads tracked by another database, e.g. one written by a shard, returning the number of rows added."""
+        # Bring the other database's schema up to date so the tables line up column for column
+        FantiaDlDatabase(db_path).close()
+        rows = 0
+        with self.lock:
+            self.commit()
+            self.cursor.execute("ATTACH DATABASE ? AS shard", (db_path,))
+            try:
+                for statement in MERGE_STATEMENTS:
+                    self.cursor.execute(statement)
+                    rows += self.cursor.rowcount
+                self.conn.commit()
+            finally:
+                self.cursor.execute("DETACH DATABASE shard")
+        return rows
+
+    def preload(self, max_bytes):
+        """Load downloaded URLs and post contents into memory so skip checks avoid queries.
+        Falls back to Bloom filters confirmed by the database when exact sets would exceed max_bytes."""
+        if self.conn is None:
+            return
+        with self.lock:
+            url_count = self.cursor.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+            post_content_count = self.cursor.execute("SELECT COUNT(*) FROM post_contents").fetchone()[0]
+            if (url_count + post_content_count) * SET_ENTRY_BYTES <= max_bytes:
+                url_index = KeyIndex()
+                post_content_index = KeyIndex()
+            else:
+                # Leave headroom for keys inserted during the run
+                total = max(url_count + post_content_count, 1)
+                url_index = BloomFilter(url_count * 2, max_bytes * url_count // total)
+                post_content_index = BloomFilter(post_content_count * 2, max_bytes * post_content_count // total)
+            for row in self.conn.execute("SELECT url FROM urls"):
+                url_index.add(row[0])
+            for row in self.conn.execute("SELECT id FROM post_contents"):
+                post_content_index.add(row[0])
+            self.url_index = url_index
+            self.post_content_index = post_content_index
+
+    def preload_memory_usage(self):
+        """Return the number of bytes held by the preloaded indexes."""
+        if self.url_index is None:
+            return 0
+        return self.url_index.memory_usage() + self.post_content_index.memory_usage()
 
     # Helper methods
 
+    def record_time(self, started):
+        if self.metrics is not None:
+            self.metrics.record_db(time.perf_counter() - started)
+
     def execute(self, query, args):
         if self.conn is None:
             return
-        self.cursor.execute(query, args)
-        self.conn.commit()
+        with self.lock:
+            started = time.perf_counter()
+            with self.profiler.phase("db"):
+                self.cursor.execute(query, args)
+            self.record_time(started)
+            self.pending_writes += 1
+            if self.commit_policy == "writes" and self.pending_writes >= self.commit_interval:
+                self.commit()
+            elif self.commit_policy == "seconds" and time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
 
     def fetchone(self, query, args):
         if self.conn is None:
             return None
-        self.cursor.execute(query, args)
-        return self.cursor.fetchone()
+        with self.lock:
+            started = time.perf_counter()
+            with self.profiler.phase("db"):
+                self.cursor.execute(query, args)
+                row = self.cursor.fetchone()
+            self.record_time(started)
+            return row
+
+    def fetchall(self, query, args):
+        if self.conn is None:
+            return []
+        with self.lock:
+            started = time.perf_counter()
+            with self.profiler.phase("db"):
+                self.cursor.execute(query, args)
+                rows = self.cursor.fetchall()
+            self.record_time(started)
+            return rows
 
     # INSERT, REPLACE
 
@@ -42,9 +278,36 @@ class FantiaDlDatabase:
 
     def insert_post_content(self, id, parent_post, title, category, price, price_unit):
         self.execute("INSERT INTO post_contents VALUES (?, ?, ?, ?, ?, ?, ?)", (id, parent_post, title, category, price, price_unit, int(time.time())))
+        if self.post_content_index is not None:
+            self.post_content_index.add(id)
+
+    def insert_url(self, url, path=None, size=None, hash=None, post_content=None):
+        # Concurrent downloads of the same URL both record it, and the latest download's file wins
+        self.execute("INSERT INTO urls (url, timestamp, path, size, hash, post_content) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET timestamp = excluded.timestamp, path = excluded.path, size = excluded.size, hash = excluded.hash, post_content = excluded.post_content", (url, int(time.time()), path, size, hash, post_content))
+        if self.url_index is not None:
+            self.url_index.add(url)
+
+    def update_fanclub_sync(self, fanclub, last_post_id, last_posted_at, runs_since_full_scan):
+        self.execute("REPLACE INTO fanclub_sync VALUES (?, ?, ?, ?, ?)", (fanclub, last_post_id, last_posted_at, runs_since_full_scan, int(time.time())))
+
+    def insert_url_extension(self, url, extension):
+        self.execute("REPLACE INTO url_extensions VALUES (?, ?, ?)", (url, extension, int(time.time())))
 
-    def insert_url(self, url):
-        self.execute("INSERT INTO urls VALUES (?, ?)", (url, int(time.time())))
+    def enqueue_post(self, id):
+        """Add a collected post to the work queue, or return it to pending if it was seen before."""
+        with self.lock:
+            self.execute("INSERT OR IGNORE INTO work_queue (kind, key, post, state, attempts, timestamp) VALUES ('post', ?, ?, 'pending', 0, ?)", (str(id), id, int(time.time())))
+            self.execute("UPDATE work_queue SET state = 'pending', timestamp = ? WHERE kind = 'post' AND key = ? AND state != 'pending'", (int(time.time()), str(id)))
+
+    def enqueue_download(self, url, filepath, use_server_filename, append_server_extension, post_content=None):
+        """Add a media download with its target path to the work queue."""
+        with self.lock:
+            self.execute("INSERT OR IGNORE INTO work_queue (kind, key, post_content, filepath, use_server_filename, append_server_extension, state, attempts, timestamp) VALUES ('download', ?, ?, ?, ?, ?, 'pending', 0, ?)", (url, post_content, filepath, int(use_server_filename), int(append_server_extension), int(time.time())))
+            self.execute("UPDATE work_queue SET filepath = ?, state = 'pending', timestamp = ? WHERE kind = 'download' AND key = ? AND state != 'pending'", (filepath, int(time.time()), url))
+
+    def insert_queued_post_content(self, id, parent_post, title, category, price, price_unit):
+        """Remember a post content's metadata until all of its queued downloads are done."""
+        self.execute("REPLACE INTO queued_post_contents VALUES (?, ?, ?, ?, ?, ?, ?)", (id, parent_post, title, category, price, price_unit, int(time.time())))
 
     # SELECT
 
@@ -52,11 +315,65 @@ class FantiaDlDatabase:
         return self.fetchone("SELECT * FROM posts WHERE id = ?", (id,))
 
     def is_post_content_downloaded(self, id):
+        if self.post_content_index is not None:
+            if id not in self.post_content_index:
+                return False
+            if self.post_content_index.exact:
+                return True
         return self.fetchone("SELECT timestamp FROM post_contents WHERE id = ?", (id,)) is not None
 
     def is_url_downloaded(self, url):
+        if self.url_index is not None:
+            if url not in self.url_index:
+                return False
+            if self.url_index.exact:
+                return True
         return self.fetchone("SELECT timestamp FROM urls WHERE url = ?", (url,)) is not None
 
+    def fetch_downloaded_files(self):
+        return self.fetchall("SELECT url, path, size, hash FROM urls", ())
+
+    def find_fanclub_sync(self, fanclub):
+        return self.fetchone("SELECT * FROM fanclub_sync WHERE fanclub = ?", (fanclub,))
+
+    def find_url_extension(self, url):
+        row = self.fetchone("SELECT extension FROM url_extensions WHERE url = ?", (url,))
+        return row["extension"] if row else None
+
+    def fetch_queue(self, kind, max_attempts):
+        """Return queued items of a kind that are pending or failed fewer than max_attempts times, oldest first."""
+        return self.fetchall("SELECT * FROM work_queue WHERE kind = ? AND (state = 'pending' OR (state = 'failed' AND attempts < ?)) ORDER BY id", (kind, max_attempts))
+
+    def count_queue(self):
+        """Return the number of queued items in each state."""
+        return {row["state"]: row["count"] for row in self.fetchall("SELECT state, COUNT(*) AS count FROM work_queue GROUP BY state", ())}
+
+    def fetch_completed_queued_post_contents(self):
+        """Return queued post contents with no downloads left outstanding."""
+        return self.fetchall("SELECT * FROM queued_post_contents WHERE NOT EXISTS (SELECT 1 FROM work_queue WHERE kind = 'download' AND post_content = queued_post_contents.id AND state != 'done')", ())
+
+    # DELETE
+
+    def delete_queued_post_content(self, id):
+        self.execute("DELETE FROM queued_post_contents WHERE id = ?", (id,))
+
+    def prune_queue(self):
+        """Drop finished work queue items, keeping the downloads of post contents that aren't complete yet."""
+        self.execute("DELETE FROM work_queue WHERE state = 'done' AND (post_content IS NULL OR post_content NOT IN (SELECT id FROM queued_post_contents))", ())
+
+    def requeue_urls(self, urls):
+        """Forget downloaded URLs, along with the post contents and posts they completed."""
+        with self.lock:
+            for url in urls:
+                row = self.fetchone("SELECT post_content FROM urls WHERE url = ?", (url,))
+                if row and row["post_content"] is not None:
+                    self.execute("UPDATE posts SET download_complete = 0 WHERE id = (SELECT parent_post FROM post_contents WHERE id = ?)", (row["post_content"],))
+                    self.execute("DELETE FROM post_contents WHERE id = ?", (row["post_content"],))
+                self.execute("DELETE FROM urls WHERE url = ?", (url,))
+            # Keep the preloaded indexes from skipping the forgotten keys
+            self.url_index = None
+            self.post_content_index = None
+
     # UPDATE
 
     def update_post_download_complete(self, id, download_complete=1):
@@ -64,3 +381,13 @@ class FantiaDlDatabase:
 
     def update_post_converted_at(self, id, converted_at):
         self.execute("UPDATE posts SET converted_at = ?, timestamp = ? WHERE id = ?", (converted_at, int(time.time()), id))
+
+    def update_queue_state(self, kind, key, state, error=None):
+        if state == "failed":
+            self.execute("UPDATE work_queue SET state = ?, attempts = attempts + 1, error = ?, timestamp = ? WHERE kind = ? AND key = ?", (state, error, int(time.time()), kind, str(key)))
+        else:
+            self.execute("UPDATE work_queue SET state = ?, error = ?, timestamp = ? WHERE kind = ? AND key = ?", (state, error, int(time.time()), kind, str(key)))
+
+    def reset_interrupted_queue(self):
+        """Return items left in progress by an interrupted run to pending."""
+        self.execute("UPDATE work_queue SET state = 'pending' WHERE state = 'in_progress'", ())
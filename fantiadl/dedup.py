@@ -0,0 +1,94 @@
+import errno
+import os
+import sys
+import threading
+
+from .verify import hash_file
+
+FICLONE = 0x40049409 # Linux ioctl to share extents between files (btrfs, XFS)
+
+DEDUP_MODES = ("hardlink", "reflink")
+
+
+def reflink(source, destination):
+    """Create a copy-on-write clone of a file. Raises OSError where reflinks aren't supported."""
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    import fcntl
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+
+def blob_path(directory, digest):
+    """Return where content with the given checksum is kept in a store."""
+    return os.path.join(directory, digest[:2], digest)
+
+
+def is_intact(path, digest, size):
+    """Return whether a stored blob still has the size and checksum it's filed under."""
+    try:
+        return os.stat(path).st_size == size and hash_file(path).hexdigest() == digest
+    except OSError:
+        return False
+
+
+class ContentStore:
+    """Content-addressed store of downloaded files keyed by checksum.
+    Files whose content is already stored are replaced by a link to the stored blob."""
+    def __init__(self, directory, mode="hardlink"):
+        if mode not in DEDUP_MODES:
+            raise ValueError("Unknown deduplication mode: {}".format(mode))
+        self.directory = directory
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.files_linked = 0
+        self.bytes_saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def blob_path(self, digest):
+        return blob_path(self.directory, digest)
+
+    def link(self, source, destination):
+        """Link destination to source, preferring a reflink when requested and falling back to a hardlink."""
+        if self.mode == "reflink":
+            try:
+                reflink(source, destination)
+                return
+            except OSError:
+                pass
+        os.link(source, destination)
+
+    def add(self, filepath, digest, size):
+        """Store a finished download, replacing it with a link if its content is already stored.
+        Returns the number of bytes saved."""
+        blob_path = self.blob_path(digest)
+        # Every linked copy shares the blob, so rehash it rather than spread a corrupted blob to another file.
+        # A corrupted blob is replaced by the fresh download below.
+        intact = os.path.isfile(blob_path) and is_intact(blob_path, digest, size)
+        with self.lock:
+            try:
+                if intact:
+                    if os.path.samefile(blob_path, filepath):
+                        return 0
+                    temporary_path = filepath + ".dedup"
+                    self.link(blob_path, temporary_path)
+                    os.replace(temporary_path, filepath)
+                    self.files_linked += 1
+                    self.bytes_saved += size
+                    return size
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                if os.path.exists(blob_path):
+                    os.remove(blob_path)
+                self.link(filepath, blob_path)
+            except OSError:
+                # e.g. the store is on another filesystem; keep the downloaded copy as is
+                return 0
+        return 0
+
+    def summary(self):
+        return "Deduplicated {} files, saving {:.1f} MB\n".format(self.files_linked, self.bytes_saved / (1024 * 1024))
@@ -4,11 +4,17 @@
 
 import argparse
 import getpass
+import multiprocessing
 import netrc
+import os
+import signal
 import sys
 import traceback
 
+from .db import FantiaDlDatabase
+from .manifest import DownloadManifest, manifest_filename
 from .models import FantiaDownloader, FantiaClub, FANTIA_URL_RE
+from .verify import verify_archive
 from .__version__ import __version__
 
 __author__ = "bitbybyte"
@@ -18,8 +24,19 @@ __license__ = "MIT"
 
 BASE_HOST = "fantia.jp"
 
-cmdl_usage = "%(prog)s [options] url"
+cmdl_usage = "%(prog)s [options] url\n       %(prog)s [options] --watch [url ...]\n       %(prog)s --db DB_PATH [-o OUTPUT_PATH] [-j #] [--repair] verify\n       %(prog)s --db DB_PATH merge-db SHARD_DB_PATH [SHARD_DB_PATH ...]"
 cmdl_version = __version__
+
+def parse_shard(value):
+    """Parse a shard given as I/N, numbered from 1."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as I/N, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard index must be between 1 and {}".format(max(count, 1)))
+    return index, count
+
 cmdl_parser = argparse.ArgumentParser(usage=cmdl_usage, conflict_handler="resolve")
 
 cmdl_parser.add_argument("-c", "--cookie", dest="session_arg", metavar="SESSION_COOKIE", help="_session_id cookie or cookies.txt")
@@ -30,7 +47,20 @@ cmdl_parser.add_argument("-q", "--quiet", action="store_true", dest="quiet", hel
 cmdl_parser.add_argument("-v", "--version", action="version", version=cmdl_version)
 cmdl_parser.add_argument("--db", dest="db_path", help="database to track post download state (creates tables when first specified)")
 cmdl_parser.add_argument("--db-bypass-post-check", action="store_true", dest="db_bypass_post_check", help="bypass checking a post for new content if it's marked as completed on the database")
-cmdl_parser.add_argument("url", action="store", nargs="*", help="fanclub or post URL")
+cmdl_parser.add_argument("--db-commit", dest="db_commit_policy", choices=["post", "writes", "seconds"], default="post", help="when to commit database writes: after each post, every --db-commit-interval writes, or every --db-commit-interval seconds (default: post)")
+cmdl_parser.add_argument("--db-commit-interval", dest="db_commit_interval", metavar="#", type=int, default=100, help="number of writes or seconds between database commits (default: 100)")
+cmdl_parser.add_argument("--db-preload", action="store_true", dest="db_preload", help="load downloaded URLs and post contents into memory to skip database lookups")
+cmdl_parser.add_argument("--db-preload-max-mb", dest="db_preload_max_mb", metavar="MB", type=int, default=64, help="memory cap for --db-preload; larger databases use a Bloom filter confirmed by the database (default: 64)")
+cmdl_parser.add_argument("--resume", action="store_true", dest="resume", help="finish the posts and downloads queued on the database by an interrupted run before anything else")
+cmdl_parser.add_argument("--incremental", action="store_true", dest="incremental", help="only collect fanclub posts newer than the last synced post on the database")
+cmdl_parser.add_argument("--full-rescan-every", dest="full_rescan_every", metavar="#", type=int, default=0, help="with --incremental, rescan all fanclub posts every # runs to catch edited posts")
+cmdl_parser.add_argument("--http-cache", dest="http_cache_directory", metavar="DIRECTORY", help="cache API responses and revalidate them and existing files with conditional requests")
+cmdl_parser.add_argument("--http-cache-ttl", dest="http_cache_ttl", metavar="DAYS", type=int, default=30, help="discard cached responses not stored or revalidated within DAYS (default: 30)")
+cmdl_parser.add_argument("--http-cache-max-mb", dest="http_cache_max_mb", metavar="MB", type=int, default=256, help="evict least recently used responses beyond MB (default: 256)")
+cmdl_parser.add_argument("--metrics-file", dest="metrics_file", metavar="PATH", help="write request, download and database metrics as JSON to PATH and in Prometheus text format next to it with a .prom extension")
+cmdl_parser.add_argument("--profile", dest="profile_directory", metavar="DIRECTORY", help="write cProfile data for each phase (pagination, post, dispatch, transfer, db) as .pstats files and sampled stacks in collapsed flame graph format to DIRECTORY")
+cmdl_parser.add_argument("--repair", action="store_true", dest="repair", help="with verify, delete missing or mismatched files from the database so they're downloaded again, along with corrupt --dedup-store blobs")
+cmdl_parser.add_argument("url", action="store", nargs="*", help="fanclub or post URL, verify to check downloaded files against their checksums, or merge-db to merge shard databases into --db")
 
 dl_group = cmdl_parser.add_argument_group("download options")
 dl_group.add_argument("-i", "--ignore-errors", action="store_true", dest="continue_on_error", help="continue on download errors")
@@ -45,12 +75,71 @@ dl_group.add_argument("-f", "--download-fanclubs", action="store_true", dest="do
 dl_group.add_argument("-p", "--download-paid-fanclubs", action="store_true", dest="download_paid_fanclubs", help="download posts from all fanclubs backed on a paid plan")
 dl_group.add_argument("-n", "--download-new-posts", dest="download_new_posts", metavar="#", type=int, help="download a specified number of new posts from your fanclub timeline")
 dl_group.add_argument("-d", "--download-month", dest="month_limit", metavar="%Y-%m", help="download posts only from a specific month, e.g. 2007-08 (excludes -n)")
+dl_group.add_argument("--crawl-ahead", dest="crawl_ahead", metavar="#", type=int, default=100, help="number of collected posts to buffer ahead of downloads (default: 100)")
+dl_group.add_argument("--prefetch-pages", dest="prefetch_pages", metavar="#", type=int, default=0, help="number of fanclub, timeline and paid plan listing pages to request ahead of the one being processed (default: 0)")
+dl_group.add_argument("--fanclub-jobs", dest="fanclub_jobs", metavar="#", type=int, default=1, help="number of fanclubs to crawl concurrently with -f/-p, interleaving their post downloads")
+dl_group.add_argument("--api-rate", dest="api_rate", metavar="#", type=float, default=4, help="maximum requests per second to fantia.jp pages and API (default: 4)")
+dl_group.add_argument("--api-concurrency", dest="api_concurrency", metavar="#", type=int, default=2, help="maximum concurrent requests to fantia.jp pages and API (default: 2)")
+dl_group.add_argument("--media-rate", dest="media_rate", metavar="#", type=float, default=0, help="maximum requests per second to media hosts (default: unlimited)")
+dl_group.add_argument("-j", "--jobs", dest="jobs", metavar="#", type=int, default=1, help="number of files to download concurrently")
+dl_group.add_argument("--jobs-per-host", dest="jobs_per_host", metavar="#", type=int, default=0, help="limit concurrent downloads from a single host (defaults to --jobs); each download's segments count as one")
+dl_group.add_argument("--segments", dest="segments", metavar="#", type=int, default=1, help="download large files over # parallel connections when the server supports byte ranges, so a host may see up to --jobs-per-host times # connections")
+dl_group.add_argument("--segment-threshold", dest="segment_threshold", metavar="MB", type=int, default=64, help="minimum file size in megabytes to use segmented downloads (default: 64)")
+dl_group.add_argument("--dedup-store", dest="dedup_directory", metavar="DIRECTORY", help="keep a content-addressed store of downloads and link files with identical content to it")
+dl_group.add_argument("--dedup-mode", dest="dedup_mode", choices=["hardlink", "reflink"], default="hardlink", help="how duplicate files are linked to the store; reflink falls back to hardlink where unsupported (default: hardlink)")
+dl_group.add_argument("--shard", dest="shard", metavar="I/N", type=parse_shard, help="download only the I-th of N deterministic partitions of the posts, so N processes can share an output directory (use a separate --db for each)")
+dl_group.add_argument("--shard-by", dest="shard_by", choices=["post", "fanclub"], default="post", help="partition --shard by post or by fanclub ID (default: post)")
+dl_group.add_argument("--plan-only", dest="plan_path", metavar="PLAN_FILE", help="collect posts and write the media they would download to a JSONL plan instead of downloading")
+dl_group.add_argument("--from-manifest", dest="from_manifest", metavar="PLAN_FILE", help="download the media listed in a plan written by --plan-only without collecting posts")
+dl_group.add_argument("--verify", action="store_true", dest="verify", help="confirm files recorded in the download manifest with the server instead of skipping them")
+dl_group.add_argument("--watch", action="store_true", dest="watch", help="keep running after downloading, polling the timeline and the first page of fanclubs given as URLs or with -f/-p for new or updated posts")
+dl_group.add_argument("--watch-interval", dest="watch_interval", metavar="SECONDS", type=int, default=60, help="seconds between polls with --watch while new posts are arriving (default: 60)")
+dl_group.add_argument("--watch-max-interval", dest="watch_max_interval", metavar="SECONDS", type=int, default=1800, help="longest wait between polls with --watch; the wait doubles after every poll that finds nothing (default: 1800)")
 dl_group.add_argument("--exclude", dest="exclude_file", metavar="EXCLUDE_FILE", help="file containing a list of filenames to exclude from downloading")
 
 
-cmdl_opts = cmdl_parser.parse_args()
+# Parsed by cli() rather than on import, since verify's worker processes re-import this module
+cmdl_opts = None
+
+def verify():
+    if not cmdl_opts.db_path:
+        sys.exit("Error: verify requires a database provided with --db")
+    directory = cmdl_opts.output_path or ""
+    db = FantiaDlDatabase(cmdl_opts.db_path)
+    manifest = DownloadManifest(os.path.join(directory, manifest_filename(cmdl_opts.shard)))
+    output = (lambda message: None) if cmdl_opts.quiet else (lambda message: sys.stdout.write(message))
+    # Verification is CPU and disk bound, so only an explicit --jobs overrides one process per core
+    jobs = cmdl_opts.jobs if cmdl_opts.jobs > 1 else None
+    intact = verify_archive(db, manifest, directory, jobs=jobs, repair=cmdl_opts.repair, output=output, dedup_directory=cmdl_opts.dedup_directory)
+    db.close()
+    manifest.close()
+    return 0 if intact else 1
+
+
+def merge_db():
+    if not cmdl_opts.db_path:
+        sys.exit("Error: merge-db requires a target database provided with --db")
+    shard_db_paths = cmdl_opts.url[1:]
+    if not shard_db_paths:
+        sys.exit("Error: merge-db requires at least one database to merge")
+    for shard_db_path in shard_db_paths:
+        if not os.path.isfile(shard_db_path):
+            sys.exit("Error: {} does not exist".format(shard_db_path))
+    db = FantiaDlDatabase(cmdl_opts.db_path)
+    for shard_db_path in shard_db_paths:
+        rows = db.merge(shard_db_path)
+        if not cmdl_opts.quiet:
+            sys.stdout.write("Merged {} rows from {}\n".format(rows, shard_db_path))
+    db.close()
+    return 0
+
 
 def main():
+    if cmdl_opts.url == ["verify"]:
+        sys.exit(verify())
+    if cmdl_opts.url[:1] == ["merge-db"]:
+        sys.exit(merge_db())
+
     session_arg = cmdl_opts.session_arg
     email = cmdl_opts.email
     password = cmdl_opts.password
@@ -58,9 +147,21 @@ def main():
     if (email or password or cmdl_opts.netrc) and not session_arg:
         sys.exit("Logging in from the command line is no longer supported. Please provide a session cookie using -c/--cookie. See the README for more information.")
 
-    if not (cmdl_opts.download_fanclubs or cmdl_opts.download_paid_fanclubs or cmdl_opts.download_new_posts) and not cmdl_opts.url:
+    if not (cmdl_opts.download_fanclubs or cmdl_opts.download_paid_fanclubs or cmdl_opts.download_new_posts or cmdl_opts.resume or cmdl_opts.from_manifest or cmdl_opts.watch) and not cmdl_opts.url:
         sys.exit("Error: No valid input provided")
 
+    if cmdl_opts.incremental and not cmdl_opts.db_path:
+        sys.exit("Error: --incremental requires a database provided with --db")
+
+    if cmdl_opts.resume and not cmdl_opts.db_path:
+        sys.exit("Error: --resume requires a database provided with --db")
+
+    if cmdl_opts.plan_path and (cmdl_opts.from_manifest or cmdl_opts.resume):
+        sys.exit("Error: --plan-only cannot be combined with --from-manifest or --resume")
+
+    if cmdl_opts.watch and cmdl_opts.plan_path:
+        sys.exit("Error: --watch cannot be combined with --plan-only")
+
     if not session_arg:
         session_arg = input("Fantia session cookie (_session_id or cookies.txt path): ")
 
@@ -77,8 +178,40 @@ def main():
     #     if not password:
     #         password = getpass.getpass("Password: ")
 
+    downloader = None
     try:
-        downloader = FantiaDownloader(session_arg=session_arg, dump_metadata=cmdl_opts.dump_metadata, parse_for_external_links=cmdl_opts.parse_for_external_links, download_thumb=cmdl_opts.download_thumb, directory=cmdl_opts.output_path, quiet=cmdl_opts.quiet, continue_on_error=cmdl_opts.continue_on_error, use_server_filenames=cmdl_opts.use_server_filenames, mark_incomplete_posts=cmdl_opts.mark_incomplete_posts, month_limit=cmdl_opts.month_limit, exclude_file=cmdl_opts.exclude_file, db_path=cmdl_opts.db_path, db_bypass_post_check=cmdl_opts.db_bypass_post_check)
+        downloader = FantiaDownloader(session_arg=session_arg, dump_metadata=cmdl_opts.dump_metadata, parse_for_external_links=cmdl_opts.parse_for_external_links, download_thumb=cmdl_opts.download_thumb, directory=cmdl_opts.output_path, quiet=cmdl_opts.quiet, continue_on_error=cmdl_opts.continue_on_error, use_server_filenames=cmdl_opts.use_server_filenames, mark_incomplete_posts=cmdl_opts.mark_incomplete_posts, month_limit=cmdl_opts.month_limit, exclude_file=cmdl_opts.exclude_file, db_path=cmdl_opts.db_path, db_bypass_post_check=cmdl_opts.db_bypass_post_check, db_commit_policy=cmdl_opts.db_commit_policy, db_commit_interval=cmdl_opts.db_commit_interval, db_preload=cmdl_opts.db_preload, db_preload_max_bytes=cmdl_opts.db_preload_max_mb * 1024 * 1024, incremental=cmdl_opts.incremental, full_rescan_every=cmdl_opts.full_rescan_every, crawl_ahead=cmdl_opts.crawl_ahead, fanclub_jobs=cmdl_opts.fanclub_jobs, api_rate=cmdl_opts.api_rate, api_concurrency=cmdl_opts.api_concurrency, media_rate=cmdl_opts.media_rate, jobs=cmdl_opts.jobs, jobs_per_host=cmdl_opts.jobs_per_host, segments=cmdl_opts.segments, segment_threshold=cmdl_opts.segment_threshold * 1024 * 1024, http_cache_directory=cmdl_opts.http_cache_directory, http_cache_ttl=cmdl_opts.http_cache_ttl * 60 * 60 * 24, http_cache_max_bytes=cmdl_opts.http_cache_max_mb * 1024 * 1024, verify=cmdl_opts.verify, dedup_directory=cmdl_opts.dedup_directory, dedup_mode=cmdl_opts.dedup_mode, plan_path=cmdl_opts.plan_path, shard=cmdl_opts.shard, shard_by=cmdl_opts.shard_by, metrics_file=cmdl_opts.metrics_file, profile_directory=cmdl_opts.profile_directory, prefetch_pages=cmdl_opts.prefetch_pages)
+        if cmdl_opts.watch:
+            def handle_sigterm(signum, frame):
+                # Once watching, let the post in progress finish so the database and work queue are left consistent
+                downloader.stop_watching()
+                if not downloader.watching:
+                    raise KeyboardInterrupt
+            signal.signal(signal.SIGTERM, handle_sigterm)
+        if cmdl_opts.resume:
+            try:
+                downloader.resume_queue()
+            except KeyboardInterrupt:
+                raise
+            except:
+                if cmdl_opts.continue_on_error:
+                    downloader.output("Encountered an error resuming the work queue. Skipping...\n")
+                    traceback.print_exc()
+                    pass
+                else:
+                    raise
+        if cmdl_opts.from_manifest:
+            try:
+                downloader.download_from_plan(cmdl_opts.from_manifest)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if cmdl_opts.continue_on_error:
+                    downloader.output("Encountered an error downloading from plan. Skipping...\n")
+                    traceback.print_exc()
+                    pass
+                else:
+                    raise
         if cmdl_opts.download_fanclubs:
             try:
                 downloader.download_followed_fanclubs(limit=cmdl_opts.limit)
@@ -111,6 +244,7 @@ def main():
                     pass
                 else:
                     raise
+        watched_fanclub_ids = []
         if cmdl_opts.url:
             for url in cmdl_opts.url:
                     url_match = FANTIA_URL_RE.match(url)
@@ -118,6 +252,7 @@ def main():
                         try:
                             url_groups = url_match.groups()
                             if url_groups[0] == "fanclubs":
+                                watched_fanclub_ids.append(url_groups[1])
                                 fanclub = FantiaClub(url_groups[1])
                                 downloader.download_fanclub(fanclub, cmdl_opts.limit)
                             elif url_groups[0] == "posts":
@@ -133,12 +268,25 @@ def main():
                                 raise
                     else:
                         sys.stderr.write("Error: {} is not a valid URL. Please provide a fully qualified Fantia URL (https://fantia.jp/posts/[id], https://fantia.jp/fanclubs/[id])\n".format(url))
+        if cmdl_opts.watch:
+            if cmdl_opts.download_fanclubs:
+                watched_fanclub_ids.extend(downloader.fetch_followed_fanclub_ids())
+            elif cmdl_opts.download_paid_fanclubs:
+                watched_fanclub_ids.extend(downloader.fetch_paid_fanclubs())
+            downloader.watch(list(dict.fromkeys(str(fanclub_id) for fanclub_id in watched_fanclub_ids)), cmdl_opts.watch_interval, cmdl_opts.watch_max_interval)
     except KeyboardInterrupt:
+        if downloader:
+            downloader.db.commit()
         sys.exit("Interrupted by user. Exiting...")
+    finally:
+        # Metrics and profiles are most useful for runs that failed or were interrupted
+        if downloader:
+            downloader.output_summary()
 
 
 def cli():
     global cmdl_opts
+    multiprocessing.freeze_support()
     cmdl_opts = cmdl_parser.parse_args()
     main()
 
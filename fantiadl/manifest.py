@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+
+MANIFEST_FILENAME = ".fantiadl-manifest.jsonl"
+
+
+def manifest_filename(shard=None):
+    """Return the manifest filename, giving each shard its own file in a shared output tree."""
+    if shard is None:
+        return MANIFEST_FILENAME
+    return ".fantiadl-manifest.shard-{}-of-{}.jsonl".format(*shard)
+
+
+class DownloadManifest:
+    """Append-only record of completed downloads kept next to the output tree.
+    Each line maps the URL path of a download to its final file, size and Last-Modified date."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.file = None
+
+        line_count = 0
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Ignore a line truncated by an interrupted write
+                    self.entries[entry["url"]] = entry
+                    line_count += 1
+        # Rewrite the manifest once superseded entries make up most of it
+        if line_count > 2 * len(self.entries):
+            self.compact()
+
+    def find(self, url):
+        """Return the recorded entry for a URL path, if any."""
+        return self.entries.get(url)
+
+    def record(self, url, path, size, last_modified=None):
+        """Record a completed download."""
+        entry = {"url": url, "path": path, "size": size, "last_modified": last_modified}
+        with self.lock:
+            self.entries[url] = entry
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def forget_paths(self, paths):
+        """Drop the entries recorded for the given file paths."""
+        paths = set(paths)
+        with self.lock:
+            self.entries = {url: entry for url, entry in self.entries.items() if entry["path"] not in paths}
+        self.compact()
+
+    def compact(self):
+        """Rewrite the manifest with only the latest entry per URL."""
+        with self.lock:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+                for entry in self.entries.values():
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(self.path + ".tmp", self.path)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class DownloadPlan:
+    """Streaming JSONL list of media to download, written by a crawl-only run and consumed by a later transfer run."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, url, path, use_server_filename, append_server_extension, size=None, post=None, post_content=None):
+        """Add a media item, with its path relative to the output directory."""
+        entry = {
+            "url": url,
+            "path": path,
+            "use_server_filename": use_server_filename,
+            "append_server_extension": append_server_extension,
+            "size": size,
+            "post": post,
+            "post_content": post_content
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    @staticmethod
+    def read(path):
+        """Iterate over the media items of a plan."""
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
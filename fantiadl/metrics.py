@@ -0,0 +1,179 @@
+from urllib.parse import urlparse
+import json
+import os
+import threading
+import time
+
+from .ratelimit import API_HOSTS
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DOWNLOAD_BUCKETS = (0.5, 1, 5, 15, 30, 60, 300, 900)
+
+
+def endpoint_class(url):
+    """Classify a request as an HTML page, an API call, an attachment download redirect or media."""
+    parsed_url = urlparse(url)
+    if parsed_url.hostname not in API_HOSTS:
+        return "media"
+    if parsed_url.path.startswith("/api/"):
+        return "api"
+    if "/download/" in parsed_url.path:
+        return "download"
+    return "html"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(key, value) for key, value in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return (upper bound, cumulative count) pairs in Prometheus order."""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield str(bound), total
+        yield "+Inf", self.count
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": dict(self.cumulative())}
+
+
+class Metrics:
+    """Counters and histograms collected over a run and exported as JSON and Prometheus text."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}
+        self.latency = {}
+        self.retries = {}
+        self.wait_seconds = {}
+        self.response_bytes = {}
+        self.downloads = {"completed": 0, "failed": 0}
+        self.download_bytes = 0
+        self.download_duration = Histogram(DOWNLOAD_BUCKETS)
+        self.skips = {}
+        self.db_seconds = 0.0
+        self.db_statements = 0
+
+    def record_request(self, url, status_code, seconds, size=None):
+        endpoint = endpoint_class(url)
+        with self.lock:
+            key = (endpoint, str(status_code))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if size:
+                self.response_bytes[endpoint] = self.response_bytes.get(endpoint, 0) + size
+
+    def record_retry(self, url):
+        endpoint = endpoint_class(url)
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def record_wait(self, url, seconds):
+        endpoint = endpoint_class(url)
+        with self.lock:
+            self.wait_seconds[endpoint] = self.wait_seconds.get(endpoint, 0.0) + seconds
+
+    def record_download(self, size, seconds):
+        with self.lock:
+            self.downloads["completed"] += 1
+            self.download_bytes += size
+            self.download_duration.observe(seconds)
+
+    def record_failed_download(self):
+        with self.lock:
+            self.downloads["failed"] += 1
+
+    def record_skip(self, reason):
+        with self.lock:
+            self.skips[reason] = self.skips.get(reason, 0) + 1
+
+    def record_db(self, seconds):
+        with self.lock:
+            self.db_seconds += seconds
+            self.db_statements += 1
+
+    def summary(self):
+        """Return every metric as a JSON-serializable dict."""
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                "timestamp": int(time.time()),
+                "duration_seconds": round(elapsed, 3),
+                "requests": [{"endpoint": endpoint, "status": status, "count": count} for (endpoint, status), count in sorted(self.requests.items())],
+                "latency_seconds": {endpoint: histogram.to_dict() for endpoint, histogram in sorted(self.latency.items())},
+                "retries": dict(self.retries),
+                "wait_seconds": {endpoint: round(seconds, 3) for endpoint, seconds in self.wait_seconds.items()},
+                "response_bytes": dict(self.response_bytes),
+                "downloads": dict(self.downloads),
+                "download_bytes": self.download_bytes,
+                "download_duration_seconds": self.download_duration.to_dict(),
+                "throughput_bytes_per_second": round(self.download_bytes / elapsed, 1) if elapsed > 0 else 0.0,
+                "skips": dict(self.skips),
+                "db_seconds": round(self.db_seconds, 3),
+                "db_statements": self.db_statements
+            }
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format, e.g. for the node exporter's textfile collector."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP fantiadl_{} {}".format(name, help_text))
+            lines.append("# TYPE fantiadl_{} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("fantiadl_{}{} {}".format(name, format_labels(labels), value))
+
+        def histogram(name, help_text, histograms):
+            lines.append("# HELP fantiadl_{} {}".format(name, help_text))
+            lines.append("# TYPE fantiadl_{} histogram".format(name))
+            for labels, data in histograms:
+                for bound, count in data["buckets"].items():
+                    lines.append("fantiadl_{}_bucket{} {}".format(name, format_labels(labels + [("le", bound)]), count))
+                lines.append("fantiadl_{}_sum{} {}".format(name, format_labels(labels), data["sum"]))
+                lines.append("fantiadl_{}_count{} {}".format(name, format_labels(labels), data["count"]))
+
+        metric("http_requests_total", "counter", "HTTP requests by endpoint class and status code.", [([("endpoint", request["endpoint"]), ("status", request["status"])], request["count"]) for request in summary["requests"]])
+        histogram("http_request_duration_seconds", "Time to response headers by endpoint class, including retries.", [([("endpoint", endpoint)], data) for endpoint, data in summary["latency_seconds"].items()])
+        metric("http_retries_total", "counter", "Retried HTTP attempts by endpoint class.", [([("endpoint", endpoint)], count) for endpoint, count in summary["retries"].items()])
+        metric("http_wait_seconds_total", "counter", "Time spent waiting on the rate limiter by endpoint class.", [([("endpoint", endpoint)], seconds) for endpoint, seconds in summary["wait_seconds"].items()])
+        metric("http_response_bytes_total", "counter", "Bytes received in non-streamed responses by endpoint class.", [([("endpoint", endpoint)], size) for endpoint, size in summary["response_bytes"].items()])
+        metric("downloads_total", "counter", "Media downloads by outcome.", [([("outcome", outcome)], count) for outcome, count in summary["downloads"].items()])
+        metric("download_bytes_total", "counter", "Bytes of completed media downloads.", [([], summary["download_bytes"])])
+        histogram("download_duration_seconds", "Duration of completed media downloads.", [([], summary["download_duration_seconds"])])
+        metric("download_skips_total", "counter", "Media downloads skipped by reason.", [([("reason", reason)], count) for reason, count in summary["skips"].items()])
+        metric("db_seconds_total", "counter", "Time spent executing database statements.", [([], summary["db_seconds"])])
+        metric("db_statements_total", "counter", "Database statements executed.", [([], summary["db_statements"])])
+        metric("run_duration_seconds", "gauge", "Duration of the run.", [([], summary["duration_seconds"])])
+        metric("download_throughput_bytes_per_second", "gauge", "Average media throughput over the run.", [([], summary["throughput_bytes_per_second"])])
+        metric("last_run_timestamp_seconds", "gauge", "Time the run finished.", [([], summary["timestamp"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the JSON summary to path and the Prometheus textfile next to it with a .prom extension."""
+        base_path, extension = os.path.splitext(path)
+        json_path = base_path + ".json" if extension == ".prom" else path
+        for output_path, content in ((json_path, json.dumps(self.summary(), indent=2)), (base_path + ".prom", self.prometheus())):
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            # Write atomically so collectors never read a partial file
+            with open(output_path + ".tmp", "w", encoding="utf-8") as file:
+                file.write(content)
+            os.replace(output_path + ".tmp", output_path)
@@ -1,29 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter, Retry
 import requests
 
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import deque
 from datetime import datetime as dt
+from email.utils import formatdate
 from email.utils import parsedate_to_datetime
 from urllib.parse import unquote
 from urllib.parse import urljoin
 from urllib.parse import urlparse
 import http.cookiejar
+import itertools
 import json
 import math
 import mimetypes
 import os
 import re
 import sys
+import threading
 import time
 import traceback
 
 from .__version__ import __version__
-from .db import FantiaDlDatabase
+from .cache import HttpCache
+from .db import FantiaDlDatabase, hash_key
+from .dedup import ContentStore
+from .metrics import Metrics
+from .parsers import get_parser
+from .manifest import DownloadManifest, DownloadPlan, manifest_filename
+from .pool import DownloadPool, PagePrefetcher, Pipeline
+from .profiling import Profiler
+from .progress import ProgressRenderer
+from .verify import hash_file, new_hash
+from .ratelimit import RateLimiter, ThrottledAdapter, ThrottledRetry
 
 FANTIA_URL_RE = re.compile(r"(?:https?://(?:(?:www\.)?(?:fantia\.jp/(fanclubs|posts)/)))([0-9]+)")
+CSRF_META_RE = re.compile(r"<meta\s[^>]*name=[\"']csrf-token[\"'][^>]*>")
+CSRF_CONTENT_RE = re.compile(r"content=[\"']([^\"']*)[\"']")
 EXTERNAL_LINKS_RE = re.compile(r"(?:[\s]+)?((?:(?:https?://)?(?:(?:www\.)?(?:mega\.nz|mediafire\.com|(?:drive|docs)\.google\.com|youtube.com|dropbox.com)\/))[^\s]+)")
 
 DOMAIN = "fantia.jp"
@@ -42,9 +57,9 @@ FANCLUB_POSTS_HTML = "https://fantia.jp/fanclubs/{}/posts?page={}"
 POST_API = "https://fantia.jp/api/v1/posts/{}"
 POST_URL = "https://fantia.jp/posts/{}"
 POSTS_URL = "https://fantia.jp/posts"
-POST_RELATIVE_URL = "/posts/"
 
-TIMELINES_API = "https://fantia.jp/api/v1/me/timelines/posts?page={}&per=24"
+TIMELINES_API = "https://fantia.jp/api/v1/me/timelines/posts?page={}&per={}"
+TIMELINE_PAGE_SIZE = 24
 
 USER_AGENT = "fantiadl/{}".format(__version__)
 
@@ -60,14 +75,33 @@ MIMETYPES = {
 
 UNICODE_CONTROL_MAP = dict.fromkeys(range(32))
 
+RESUME_ATTEMPTS = 5
+WATCH_BACKOFF = 2 # polls that find nothing multiply the watch interval by this, up to the maximum
+WATCH_TIMELINE_PAGES = 5 # timeline pages checked per poll while every post on a page is new
+QUEUE_MAX_ATTEMPTS = 3 # failed work queue items are retried by --resume until they've failed this many times
+
 
 class FantiaClub:
     def __init__(self, fanclub_id):
         self.id = fanclub_id
+        self.newest_post_id = None
+        self.newest_posted_at = None
+
+
+class FanclubCrawl:
+    """State of a fanclub whose posts are being collected and downloaded."""
+    def __init__(self, fanclub, limit=0):
+        self.fanclub = fanclub
+        self.limit = limit
+        self.watermark = None
+        self.runs_since_full_scan = 0
+        self.pipeline = None
+        self.post_count = 0
+        self.errors = False
 
 
 class FantiaDownloader:
-    def __init__(self, session_arg, chunk_size=1024 * 1024 * 5, dump_metadata=False, parse_for_external_links=False, download_thumb=False, directory=None, quiet=True, continue_on_error=False, use_server_filenames=False, mark_incomplete_posts=False, month_limit=None, exclude_file=None, db_path=None, db_bypass_post_check=False):
+    def __init__(self, session_arg, chunk_size=1024 * 1024 * 5, dump_metadata=False, parse_for_external_links=False, download_thumb=False, directory=None, quiet=True, continue_on_error=False, use_server_filenames=False, mark_incomplete_posts=False, month_limit=None, exclude_file=None, db_path=None, db_bypass_post_check=False, db_commit_policy="post", db_commit_interval=100, db_preload=False, db_preload_max_bytes=1024 * 1024 * 64, incremental=False, full_rescan_every=0, crawl_ahead=100, fanclub_jobs=1, api_rate=4, api_concurrency=2, media_rate=0, jobs=1, jobs_per_host=0, segments=1, segment_threshold=1024 * 1024 * 64, http_cache_directory=None, http_cache_ttl=60 * 60 * 24 * 30, http_cache_max_bytes=1024 * 1024 * 256, verify=False, dedup_directory=None, dedup_mode="hardlink", plan_path=None, shard=None, shard_by="post", metrics_file=None, profile_directory=None, prefetch_pages=0):
         # self.email = email
         # self.password = password
         self.session_arg = session_arg
@@ -83,29 +117,55 @@ class FantiaDownloader:
         self.month_limit = dt.strptime(month_limit, "%Y-%m") if month_limit else None
         self.exclude_file = exclude_file
         self.exclusions = []
-        self.db = FantiaDlDatabase(db_path)
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self.profiler = Profiler(profile_directory)
+        self.db = FantiaDlDatabase(db_path, db_commit_policy, db_commit_interval, self.metrics, self.profiler)
         self.db_bypass_post_check = db_bypass_post_check
+        self.incremental = incremental
+        self.full_rescan_every = full_rescan_every
+        self.crawl_ahead = crawl_ahead
+        self.prefetch_pages = prefetch_pages
+        self.fanclub_jobs = fanclub_jobs
+        self.limiter = RateLimiter(api_rate, api_concurrency, media_rate, max(1, jobs), on_backoff=self.output_backoff)
+        self.pool = DownloadPool(jobs, jobs_per_host, self.limiter.classes["media"])
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.progress = ProgressRenderer(enabled=not quiet, queue_depth=self.pool.queue_depth)
+        self.http_cache = HttpCache(http_cache_directory, http_cache_ttl, http_cache_max_bytes) if http_cache_directory else None
+        self.shard = shard
+        self.shard_by = shard_by
+        self.manifest = DownloadManifest(os.path.join(self.directory, manifest_filename(shard)))
+        self.verify = verify
+        self.content_store = ContentStore(dedup_directory, dedup_mode) if dedup_directory else None
+        self.plan = DownloadPlan(plan_path) if plan_path else None
+        self.html_parser = get_parser()
+        self.csrf_token = None
+        self.csrf_lock = threading.Lock()
+        self.downloads_in_flight = {}
+        self.downloads_lock = threading.RLock()
+        self.watch_stopped = threading.Event()
+        self.watching = False
+        self.handled_posts = set()
 
         self.initialize_session()
         self.login()
         self.create_exclusions()
+        if db_preload and self.db.conn:
+            self.preload_database(db_preload_max_bytes)
+        self.db.prune_queue()
 
     def output(self, output):
         """Write output to the console."""
         if not self.quiet:
-            try:
-                sys.stdout.write(output.encode(sys.stdout.encoding, errors="backslashreplace").decode(sys.stdout.encoding))
-                sys.stdout.flush()
-            except (UnicodeEncodeError, UnicodeDecodeError):
-                sys.stdout.buffer.write(output.encode("utf-8"))
-                sys.stdout.flush()
+            self.progress.write(output)
 
     def initialize_session(self):
         """Initialize session with necessary headers and config."""
 
         self.session = requests.session()
         self.session.headers.update({"User-Agent": USER_AGENT})
-        retries = Retry(
+        retries = ThrottledRetry(
             total=5,
             connect=5,
             read=5,
@@ -113,8 +173,58 @@ class FantiaDownloader:
             backoff_factor=2, # retry delay = {backoff factor} * (2 ** ({retry number} - 1))
             raise_on_status=True
         )
-        self.session.mount("http://", HTTPAdapter(max_retries=retries))
-        self.session.mount("https://", HTTPAdapter(max_retries=retries))
+        retries.limiter = self.limiter
+        retries.metrics = self.metrics
+        # Every download may hold up to --segments connections at once
+        pool_size = max(10, self.pool.jobs * self.segments)
+        self.session.mount("http://", ThrottledAdapter(self.limiter, max_retries=retries, pool_maxsize=pool_size, metrics=self.metrics))
+        self.session.mount("https://", ThrottledAdapter(self.limiter, max_retries=retries, pool_maxsize=pool_size, metrics=self.metrics))
+
+    def output_backoff(self, host_limiter, status_code, delay):
+        """Report a throttling response from the server."""
+        self.output("Throttled by {} host (HTTP {}). Backing off to concurrency {}{}{}.\n".format(
+            host_limiter.name,
+            status_code,
+            int(host_limiter.concurrency),
+            ", {:.2f} requests/s".format(host_limiter.rate) if host_limiter.rate is not None else "",
+            ", waiting {:.0f}s".format(delay) if delay else ""
+        ))
+
+    def output_summary(self):
+        """Write statistics gathered over the run to the console."""
+        self.progress.close()
+        self.output(self.progress.summary())
+        self.output("Request rates:\n" + self.limiter.summary())
+        if self.http_cache:
+            self.output(self.http_cache.summary())
+        if self.content_store:
+            self.output(self.content_store.summary())
+        if self.plan:
+            self.output("Planned {} downloads in {}\n".format(self.plan.count, self.plan.path))
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file)
+        profile_paths = self.profiler.close()
+        if profile_paths:
+            self.output("Wrote profiles: {}\n".format(", ".join(profile_paths)))
+
+    def in_shard(self, key):
+        """Return whether this process's shard is responsible for a post or fanclub ID."""
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return hash_key(int(key)) % count == index - 1
+
+    def owns_post(self, post_id):
+        return self.shard_by != "post" or self.in_shard(post_id)
+
+    def owns_fanclub(self, fanclub_id):
+        return self.shard_by != "fanclub" or self.in_shard(fanclub_id)
+
+    def fetch(self, url, headers=None):
+        """Perform a GET request, revalidating against the HTTP cache when enabled."""
+        if self.http_cache:
+            return self.http_cache.get(self.session, url, headers)
+        return self.session.get(url, headers=headers)
 
     def login(self):
         """Login to Fantia using the provided email and password."""
@@ -157,19 +267,23 @@ class FantiaDownloader:
         # if not (check_user.ok or check_user.status_code == 304):
         #     sys.exit("Error: Invalid session")
 
+    def preload_database(self, max_bytes):
+        """Load the database's downloaded URLs and post contents into memory for skip checks."""
+        self.output("Preloading database...\n")
+        self.db.preload(max_bytes)
+        self.output("Preloaded {} URLs and {} post contents ({:.1f} MB{}).\n".format(
+            len(self.db.url_index),
+            len(self.db.post_content_index),
+            self.db.preload_memory_usage() / (1024 * 1024),
+            "" if self.db.url_index.exact else ", Bloom filter"
+        ))
+
     def create_exclusions(self):
         """Read files to exclude from downloading."""
         if self.exclude_file:
             with open(self.exclude_file, "r") as file:
                 self.exclusions = [line.rstrip("\n") for line in file]
 
-    def process_content_type(self, url):
-        """Process the Content-Type from a request header and use it to build a filename."""
-        url_header = self.session.head(url, allow_redirects=True)
-        mimetype = url_header.headers["Content-Type"]
-        extension = guess_extension(mimetype, url)
-        return extension
-
     def collect_post_titles(self, post_metadata):
         """Collect all post titles to check for duplicate names and rename as necessary by appending a counter."""
         post_titles = []
@@ -192,43 +306,354 @@ class FantiaDownloader:
 
     def download_fanclub_metadata(self, fanclub):
         """Download fanclub header, icon, and custom background."""
-        response = self.session.get(FANCLUB_API.format(fanclub.id))
+        # Shards split by post all crawl the fanclub, so only one of them saves its metadata
+        if not self.in_shard(fanclub.id):
+            return
+        response = self.fetch(FANCLUB_API.format(fanclub.id))
         response.raise_for_status()
         fanclub_json = json.loads(response.text)
 
         fanclub_creator = fanclub_json["fanclub"]["creator_name"]
         fanclub_directory = os.path.join(self.directory, sanitize_for_path(fanclub_creator))
-        os.makedirs(fanclub_directory, exist_ok=True)
-
-        self.save_metadata(fanclub_json, fanclub_directory)
+        if not self.plan:
+            os.makedirs(fanclub_directory, exist_ok=True)
+            self.save_metadata(fanclub_json, fanclub_directory)
 
+        downloads = []
         header_url = fanclub_json["fanclub"]["cover"]["original"]
         if header_url:
-            header_filename = os.path.join(fanclub_directory, "header" + self.process_content_type(header_url))
+            header_filename = os.path.join(fanclub_directory, "header")
             self.output("Downloading fanclub header...\n")
-            self.perform_download(header_url, header_filename, use_server_filename=self.use_server_filenames)
+            downloads.append(self.queue_download(header_url, header_filename, use_server_filename=self.use_server_filenames, append_server_extension=True))
 
         fanclub_icon_url = fanclub_json["fanclub"]["icon"]["original"]
         if fanclub_icon_url:
-            fanclub_icon_filename = os.path.join(fanclub_directory, "icon" + self.process_content_type(fanclub_icon_url))
+            fanclub_icon_filename = os.path.join(fanclub_directory, "icon")
             self.output("Downloading fanclub icon...\n")
-            self.perform_download(fanclub_icon_url, fanclub_icon_filename, use_server_filename=self.use_server_filenames)
+            downloads.append(self.queue_download(fanclub_icon_url, fanclub_icon_filename, use_server_filename=self.use_server_filenames, append_server_extension=True))
 
         background_url = fanclub_json["fanclub"]["background"]
         if background_url:
-            background_filename = os.path.join(fanclub_directory, "background" + self.process_content_type(background_url))
+            background_filename = os.path.join(fanclub_directory, "background")
             self.output("Downloading fanclub background...\n")
-            self.perform_download(background_url, background_filename, use_server_filename=self.use_server_filenames)
+            downloads.append(self.queue_download(background_url, background_filename, use_server_filename=self.use_server_filenames, append_server_extension=True))
+
+        self.pool.wait(downloads)
 
     def download_fanclub(self, fanclub, limit=0):
         """Download a fanclub."""
+        if not self.owns_fanclub(fanclub.id):
+            self.output("Fanclub {} belongs to another shard. Skipping...\n".format(fanclub.id))
+            return
+        crawl = self.start_fanclub_crawl(fanclub, limit)
+        with crawl.pipeline as post_ids:
+            if self.dump_metadata:
+                self.download_fanclub_metadata(fanclub)
+
+            for post_id in post_ids if limit == 0 else itertools.islice(post_ids, limit):
+                self.download_fanclub_post(crawl, post_id)
+        self.finish_fanclub_crawl(crawl)
+
+    def start_fanclub_crawl(self, fanclub, limit=0):
+        """Start collecting a fanclub's posts in the background."""
         self.output("Downloading fanclub {}...\n".format(fanclub.id))
-        post_ids = self.fetch_fanclub_posts(fanclub)
+        crawl = FanclubCrawl(fanclub, limit)
+        if self.incremental:
+            fanclub_sync = self.db.find_fanclub_sync(fanclub.id)
+            if fanclub_sync:
+                crawl.runs_since_full_scan = fanclub_sync["runs_since_full_scan"] + 1
+                if self.full_rescan_every and crawl.runs_since_full_scan >= self.full_rescan_every:
+                    self.output("Performing full rescan of fanclub...\n")
+                    crawl.runs_since_full_scan = 0
+                else:
+                    crawl.watermark = fanclub_sync
+        # Posts are downloaded as soon as they're collected while pagination continues in the background
+        crawl.pipeline = Pipeline(self.fetch_fanclub_posts(fanclub, crawl.watermark), self.crawl_ahead)
+        return crawl
+
+    def download_fanclub_post(self, crawl, post_id):
+        """Download a post collected from a fanclub."""
+        crawl.post_count += 1
+        try:
+            self.download_post(post_id)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.continue_on_error:
+                self.output("Encountered an error downloading post. Skipping...\n")
+                traceback.print_exc()
+                crawl.errors = True
+            else:
+                raise
+
+    def finish_fanclub_crawl(self, crawl):
+        """Stop collecting a fanclub's posts once all of them have been downloaded."""
+        crawl.pipeline.close()
+        fanclub = crawl.fanclub
+        # Only advance the watermark after a complete, error-free pass over every newer post
+        if self.incremental and not self.plan and not crawl.errors and crawl.limit == 0 and not self.month_limit:
+            if fanclub.newest_post_id is not None:
+                self.db.update_fanclub_sync(fanclub.id, fanclub.newest_post_id, fanclub.newest_posted_at, crawl.runs_since_full_scan)
+            elif crawl.watermark:
+                self.db.update_fanclub_sync(fanclub.id, crawl.watermark["last_post_id"], crawl.watermark["last_posted_at"], crawl.runs_since_full_scan)
+
+    def download_fanclubs(self, fanclub_ids, limit=0):
+        """Download several fanclubs, crawling up to fanclub_jobs of them at once and interleaving their posts."""
+        fanclub_ids = (fanclub_id for fanclub_id in fanclub_ids if self.owns_fanclub(fanclub_id))
+        if self.fanclub_jobs <= 1:
+            for fanclub_id in fanclub_ids:
+                try:
+                    fanclub = FantiaClub(fanclub_id)
+                    self.download_fanclub(fanclub, limit)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    if self.continue_on_error:
+                        self.output("Encountered an error downloading fanclub. Skipping...\n")
+                        traceback.print_exc()
+                        continue
+                    else:
+                        raise
+            return
+
+        pending_fanclub_ids = iter(fanclub_ids)
+        active_crawls = deque()
+        idle_polls = 0
+        try:
+            while True:
+                while len(active_crawls) < self.fanclub_jobs:
+                    fanclub_id = next(pending_fanclub_ids, None)
+                    if fanclub_id is None:
+                        break
+                    crawl = None
+                    try:
+                        crawl = self.start_fanclub_crawl(FantiaClub(fanclub_id), limit)
+                        if self.dump_metadata:
+                            self.download_fanclub_metadata(crawl.fanclub)
+                        active_crawls.append(crawl)
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        if crawl:
+                            crawl.pipeline.close()
+                        if self.continue_on_error:
+                            self.output("Encountered an error downloading fanclub. Skipping...\n")
+                            traceback.print_exc()
+                        else:
+                            raise
+                if not active_crawls:
+                    break
+
+                # Round-robin over fanclubs, downloading one collected post from each in turn.
+                # Only wait on a crawl once every active crawl has come up empty.
+                crawl = active_crawls.popleft()
+                try:
+                    kind, post_id = crawl.pipeline.poll(timeout=0.1 if idle_polls > len(active_crawls) else 0)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    crawl.pipeline.close()
+                    if self.continue_on_error:
+                        self.output("Encountered an error downloading fanclub. Skipping...\n")
+                        traceback.print_exc()
+                        continue
+                    else:
+                        raise
+                if kind == Pipeline.DONE:
+                    self.finish_fanclub_crawl(crawl)
+                    continue
+                if kind == Pipeline.EMPTY:
+                    active_crawls.append(crawl)
+                    idle_polls += 1
+                    continue
+
+                idle_polls = 0
+                try:
+                    self.download_fanclub_post(crawl, post_id)
+                except:
+                    # The crawl is out of active_crawls while its post downloads, so close it here
+                    crawl.pipeline.close()
+                    raise
+                if crawl.limit and crawl.post_count >= crawl.limit:
+                    self.finish_fanclub_crawl(crawl)
+                else:
+                    active_crawls.append(crawl)
+        finally:
+            for crawl in active_crawls:
+                crawl.pipeline.close()
 
-        if self.dump_metadata:
-            self.download_fanclub_metadata(fanclub)
+    def download_followed_fanclubs(self, limit=0):
+        """Download all followed fanclubs."""
+        self.download_fanclubs(self.fetch_followed_fanclub_ids(), limit)
+
+    def fetch_followed_fanclub_ids(self):
+        """Fetch the IDs of all followed fanclubs."""
+        response = self.session.get(FANCLUBS_FOLLOWING_API)
+        response.raise_for_status()
+        return json.loads(response.text)["fanclub_ids"]
+
+    def download_paid_fanclubs(self, limit=0):
+        """Download all fanclubs backed on a paid plan."""
+        with Pipeline(self.fetch_paid_fanclubs(), self.crawl_ahead) as fanclub_ids:
+            self.download_fanclubs(fanclub_ids, limit)
+
+    def fetch_paid_fanclubs(self):
+        """Iterate over the paid plan HTML pages to fetch all fanclub IDs."""
+        fanclub_count = 0
+        self.output("Collecting paid fanclubs...\n")
+        with PagePrefetcher(self.fetch_paid_fanclubs_page, self.prefetch_pages) as pages:
+            for fanclub_ids in pages:
+                for fanclub_id in fanclub_ids:
+                    fanclub_count += 1
+                    yield fanclub_id
+                if not fanclub_ids:
+                    self.output("Collected {} fanclubs.\n".format(fanclub_count))
+                    return
+
+    def fetch_paid_fanclubs_page(self, page_number):
+        """Fetch the fanclub IDs on a paid plan HTML page."""
+        with self.profiler.phase("pagination"):
+            response = self.session.get(FANCLUBS_PAID_HTML.format(page_number))
+            response.raise_for_status()
+            return self.html_parser.paid_fanclub_ids(response.text)
+
+    def download_new_posts(self, post_limit=24):
+        """Download new posts from the fanclub timeline."""
+        self.output("Downloading {} new posts...\n".format(post_limit))
+        with Pipeline(self.fetch_new_posts(post_limit), self.crawl_ahead) as post_ids:
+            for post_id in post_ids:
+                try:
+                    self.download_post(post_id)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    if self.continue_on_error:
+                        self.output("Encountered an error downloading post. Skipping...\n")
+                        traceback.print_exc()
+                        continue
+                    else:
+                        raise
+
+    def fetch_new_posts(self, post_limit=24):
+        """Iterate over the timeline API pages to fetch new post IDs."""
+        post_count = 0
+        with PagePrefetcher(self.fetch_timeline_page, self.prefetch_pages, math.ceil(post_limit / TIMELINE_PAGE_SIZE)) as pages:
+            for json_response in pages:
+                for post in json_response["posts"]:
+                    if post_count >= post_limit:
+                        break
+                    post_count += 1
+                    # The timeline mixes fanclubs, so it's always split by post
+                    if self.in_shard(post["id"]):
+                        yield post["id"]
+                if not json_response["has_next"] or post_count >= post_limit:
+                    return
+
+    def fetch_timeline_page(self, page_number):
+        """Fetch a page of the timeline API."""
+        with self.profiler.phase("pagination"):
+            response = self.session.get(TIMELINES_API.format(page_number, TIMELINE_PAGE_SIZE))
+            response.raise_for_status()
+            return json.loads(response.text)
 
-        for post_id in post_ids if limit == 0 else post_ids[:limit]:
+    def fetch_fanclub_posts(self, fanclub, watermark=None):
+        """Iterate over a fanclub's HTML pages to fetch all post IDs, stopping at the watermark if provided."""
+        post_count = 0
+        post_found = False
+        watermark_reached = False
+        self.output("Collecting fanclub posts...\n")
+        with PagePrefetcher(lambda page_number: self.fetch_fanclub_posts_page(fanclub, page_number), self.prefetch_pages) as pages:
+            for posts in pages:
+                new_post_ids = []
+                for post_id, parsed_date in posts:
+                    if fanclub.newest_post_id is None or int(post_id) > fanclub.newest_post_id:
+                        fanclub.newest_post_id = int(post_id)
+                        fanclub.newest_posted_at = int(parsed_date.timestamp())
+                    if watermark and int(post_id) <= watermark["last_post_id"] and int(parsed_date.timestamp()) <= watermark["last_posted_at"]:
+                        watermark_reached = True
+                        continue
+                    if not self.month_limit or (parsed_date.year == self.month_limit.year and parsed_date.month == self.month_limit.month):
+                        post_found = True
+                        new_post_ids.append(post_id)
+                        post_count += 1
+                        if self.owns_post(post_id):
+                            yield post_id
+                if not posts or (not new_post_ids and post_found) or watermark_reached: # No new posts found and we've already collected a post
+                    self.output("Collected {} posts.\n".format(post_count))
+                    return
+
+    def fetch_fanclub_posts_page(self, fanclub, page_number):
+        """Fetch the post IDs and dates on one of a fanclub's HTML pages."""
+        with self.profiler.phase("pagination"):
+            response = self.session.get(FANCLUB_POSTS_HTML.format(fanclub.id, page_number))
+            response.raise_for_status()
+            self.csrf_token = find_csrf_token(response.text) or self.csrf_token
+            return self.html_parser.fanclub_posts(response.text)
+
+    def watch(self, fanclub_ids=(), interval=60, max_interval=60 * 30):
+        """Poll the timeline, and the first page of each given fanclub, downloading new or changed posts until stopped.
+        The interval resets whenever a poll finds posts and grows while polls come up empty."""
+        fanclubs = [FantiaClub(fanclub_id) for fanclub_id in fanclub_ids if self.owns_fanclub(fanclub_id)]
+        # Posts handled by the initial sync have no version yet and adopt the timeline's, rather than being downloaded again
+        seen_posts = dict.fromkeys(self.handled_posts)
+        delay = interval
+        self.watching = True
+        self.output("Watching {} for new posts...\n".format("the timeline and {} fanclubs".format(len(fanclubs)) if fanclubs else "the timeline"))
+        while not self.watch_stopped.is_set():
+            try:
+                found = self.poll_new_posts(fanclubs, seen_posts)
+            except Exception:
+                # Outages and odd responses are expected over a long run, so retry at the next poll instead of exiting
+                self.output("Encountered an error polling for new posts. Retrying later...\n")
+                traceback.print_exc()
+                found = 0
+            delay = interval if found else min(max_interval, delay * WATCH_BACKOFF)
+            self.db.commit()
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+            if not self.watch_stopped.is_set():
+                self.output("Next poll in {:.0f}s.\n".format(delay))
+                self.watch_stopped.wait(delay)
+        self.output("Stopped watching.\n")
+
+    def stop_watching(self):
+        """Stop watching once the post being downloaded is finished, e.g. on SIGTERM."""
+        self.watch_stopped.set()
+
+    def poll_new_posts(self, fanclubs, seen_posts):
+        """Download posts that are new or changed since they were last seen, returning how many were found.
+        seen_posts maps post IDs to the version they were downloaded at and is updated in place."""
+        new_posts = {}
+        # With nothing seen yet only the latest page is looked at; otherwise page back in case more posts arrived than fit on one
+        max_pages = WATCH_TIMELINE_PAGES if seen_posts else 1
+        for page_number in range(1, max_pages + 1):
+            json_response = self.fetch_timeline_page(page_number)
+            page_is_new = bool(json_response["posts"])
+            for post in json_response["posts"]:
+                version = post.get("converted_at") or post.get("posted_at")
+                # Posts first seen on a fanclub page have no version yet; adopt the timeline's
+                if post["id"] in seen_posts and seen_posts[post["id"]] in (None, version):
+                    seen_posts[post["id"]] = version
+                    page_is_new = False
+                elif self.in_shard(post["id"]):
+                    new_posts.setdefault(post["id"], version)
+            if not page_is_new or not json_response["has_next"]:
+                break
+        for fanclub in fanclubs:
+            for post_id, _ in self.fetch_fanclub_posts_page(fanclub, 1):
+                post_id = int(post_id)
+                if post_id not in seen_posts and self.owns_post(post_id):
+                    new_posts.setdefault(post_id, seen_posts.get(post_id))
+
+        if new_posts:
+            self.output("Found {} new or updated posts.\n".format(len(new_posts)))
+        if not self.plan:
+            for post_id in new_posts:
+                self.db.enqueue_post(post_id)
+        for post_id, version in new_posts.items():
+            # Posts left behind stay queued on the database for --resume
+            if self.watch_stopped.is_set():
+                break
             try:
                 self.download_post(post_id)
             except KeyboardInterrupt:
@@ -240,83 +665,139 @@ class FantiaDownloader:
                     continue
                 else:
                     raise
-
-    def download_followed_fanclubs(self, limit=0):
-        """Download all followed fanclubs."""
-        response = self.session.get(FANCLUBS_FOLLOWING_API)
-        response.raise_for_status()
-        fanclub_ids = json.loads(response.text)["fanclub_ids"]
-
-        for fanclub_id in fanclub_ids:
+            # Only remember posts once downloaded, so failures are retried at the next poll
+            seen_posts[post_id] = version
+        return len(new_posts)
+
+    def queue_download(self, url, filepath, use_server_filename=False, append_server_extension=False, post_content_id=None, post_id=None, enqueued=False):
+        """Record a download in the work queue, schedule it on the shared download pool and return its future.
+        When planning, the download is written to the plan instead. Pass enqueued if the work queue already has the download."""
+        if self.plan:
+            future = Future()
+            future.set_result(self.plan_download(url, filepath, use_server_filename, append_server_extension, post_content_id, post_id))
+            return future
+        if not enqueued:
+            self.db.enqueue_download(url, filepath, use_server_filename, append_server_extension, post_content_id)
+        # A URL already being downloaded shares its future, as it would be skipped once that download finished
+        url_path = unquote(url.split("?", 1)[0])
+        with self.downloads_lock:
+            future = self.downloads_in_flight.get(url_path)
+            if future is None:
+                future = self.pool.submit(url, self.perform_queued_download, filepath, use_server_filename=use_server_filename, append_server_extension=append_server_extension, post_content_id=post_content_id)
+                self.downloads_in_flight[url_path] = future
+                future.add_done_callback(lambda future: self.forget_download(url_path))
+        return future
+
+    def forget_download(self, url_path):
+        with self.downloads_lock:
+            self.downloads_in_flight.pop(url_path, None)
+
+    def perform_queued_download(self, url, filepath, use_server_filename=False, append_server_extension=False, post_content_id=None):
+        """Perform a download, tracking its state in the work queue."""
+        self.db.update_queue_state("download", url, "in_progress")
+        try:
+            with self.profiler.phase("transfer"):
+                self.perform_download(url, filepath, use_server_filename, append_server_extension, post_content_id)
+        except Exception as error:
+            self.metrics.record_failed_download()
+            self.db.update_queue_state("download", url, "failed", str(error))
+            raise
+        self.db.update_queue_state("download", url, "done")
+
+    def plan_download(self, url, filepath, use_server_filename, append_server_extension, post_content_id=None, post_id=None):
+        """Write a download to the plan unless it's already known to be downloaded."""
+        url_path = unquote(url.split("?", 1)[0])
+        if self.db.conn and self.db.is_url_downloaded(url_path):
+            return
+        manifest_entry = self.manifest.find(url_path)
+        if manifest_entry:
+            manifest_filepath = os.path.join(self.directory, manifest_entry["path"])
+            if os.path.isfile(manifest_filepath) and os.stat(manifest_filepath).st_size == manifest_entry["size"]:
+                return
+        # Sizes are only known up front for files downloaded before; everything else is resolved by the transfer run
+        self.plan.write(url, self.relative_path(filepath), use_server_filename, append_server_extension, manifest_entry["size"] if manifest_entry else None, post_id, post_content_id)
+
+    def download_from_plan(self, plan_path):
+        """Download every media item of a plan written by --plan-only on the download pool."""
+        self.output("Downloading from plan {}...\n".format(plan_path))
+        in_flight = set()
+        failures = 0
+        for entry in DownloadPlan.read(plan_path):
+            filepath = os.path.join(self.directory, entry["path"])
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
             try:
-                fanclub = FantiaClub(fanclub_id)
-                self.download_fanclub(fanclub, limit)
+                in_flight.add(self.queue_download(entry["url"], filepath, use_server_filename=entry["use_server_filename"], append_server_extension=entry["append_server_extension"], post_content_id=entry["post_content"]))
             except KeyboardInterrupt:
                 raise
             except:
                 if self.continue_on_error:
-                    self.output("Encountered an error downloading fanclub. Skipping...\n")
+                    self.output("Encountered an error downloading planned file. Skipping...\n")
                     traceback.print_exc()
-                    continue
+                    failures += 1
                 else:
                     raise
-
-    def download_paid_fanclubs(self, limit=0):
-        """Download all fanclubs backed on a paid plan."""
-        all_paid_fanclubs = []
-        page_number = 1
-        self.output("Collecting paid fanclubs...\n")
-        while True:
-            response = self.session.get(FANCLUBS_PAID_HTML.format(page_number))
-            response.raise_for_status()
-            response_page = BeautifulSoup(response.text, "html.parser")
-            fanclub_links = response_page.select("div.mb-5-children > div:nth-of-type(1) a[href^=\"/fanclubs\"]")
-
-            for fanclub_link in fanclub_links:
-                fanclub_id = fanclub_link["href"].lstrip("/fanclubs/")
-                all_paid_fanclubs.append(fanclub_id)
-            if not fanclub_links:
-                self.output("Collected {} fanclubs.\n".format(len(all_paid_fanclubs)))
-                break
-            else:
-                page_number += 1
-
-        for fanclub_id in all_paid_fanclubs:
+            # Keep the number of scheduled downloads bounded, however large the plan is
+            if len(in_flight) >= self.pool.jobs * 4:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                failures += self.check_plan_downloads(finished)
+                self.db.checkpoint()
+        finished, _ = wait(in_flight)
+        failures += self.check_plan_downloads(finished)
+        self.db.commit()
+        self.output("Finished plan with {} failed downloads.\n".format(failures))
+
+    def check_plan_downloads(self, futures):
+        """Raise the first error among finished plan downloads, or count the errors when continuing on error."""
+        failures = 0
+        for future in futures:
+            exception = future.exception()
+            if exception is None:
+                continue
+            if not self.continue_on_error:
+                raise exception
+            self.output("Encountered an error downloading planned file: {}\n".format(exception))
+            failures += 1
+        return failures
+
+    def resume_queue(self):
+        """Drain the work queue left by an interrupted run without crawling again.
+        Queued downloads are finished first so resumed posts find their contents already complete."""
+        self.db.reset_interrupted_queue()
+        queued_downloads = self.db.fetch_queue("download", QUEUE_MAX_ATTEMPTS)
+        queued_posts = self.db.fetch_queue("post", QUEUE_MAX_ATTEMPTS)
+        self.output("Resuming {} queued downloads and {} queued posts...\n".format(len(queued_downloads), len(queued_posts)))
+
+        downloads = []
+        for queued_download in queued_downloads:
             try:
-                fanclub = FantiaClub(fanclub_id)
-                self.download_fanclub(fanclub, limit)
+                downloads.append(self.pool.submit(queued_download["key"], self.perform_queued_download, queued_download["filepath"], use_server_filename=bool(queued_download["use_server_filename"]), append_server_extension=bool(queued_download["append_server_extension"]), post_content_id=queued_download["post_content"]))
+            except KeyboardInterrupt:
+                raise
             except:
                 if self.continue_on_error:
-                    self.output("Encountered an error downloading fanclub. Skipping...\n")
+                    self.output("Encountered an error downloading queued file. Skipping...\n")
                     traceback.print_exc()
-                    continue
                 else:
                     raise
+        try:
+            self.pool.wait(downloads)
+        except KeyboardInterrupt:
+            raise
+        except:
+            if self.continue_on_error:
+                self.output("Encountered an error downloading queued files. Skipping...\n")
+                traceback.print_exc()
+            else:
+                raise
 
-    def download_new_posts(self, post_limit=24):
-        all_new_post_ids = []
-        total_pages = math.ceil(post_limit / 24)
-        page_number = 1
-        has_next = True
-        self.output("Downloading {} new posts...\n".format(post_limit))
-
-        while has_next and not len(all_new_post_ids) >= post_limit:
-            response = self.session.get(TIMELINES_API.format(page_number))
-            response.raise_for_status()
-            json_response = json.loads(response.text)
-
-            posts = json_response["posts"]
-            has_next = json_response["has_next"]
-            for post in posts:
-                if len(all_new_post_ids) >= post_limit:
-                    break
-                post_id = post["id"]
-                all_new_post_ids.append(post_id)
-            page_number += 1
+        for post_content in self.db.fetch_completed_queued_post_contents():
+            self.db.insert_post_content(post_content["id"], post_content["parent_post"], post_content["title"], post_content["category"], post_content["price"], post_content["currency"])
+            self.db.delete_queued_post_content(post_content["id"])
+        self.db.commit()
 
-        for post_id in all_new_post_ids:
+        for queued_post in queued_posts:
             try:
-                self.download_post(post_id)
+                self.download_post(queued_post["key"])
             except KeyboardInterrupt:
                 raise
             except:
@@ -327,56 +808,67 @@ class FantiaDownloader:
                 else:
                     raise
 
-    def fetch_fanclub_posts(self, fanclub):
-        """Iterate over a fanclub's HTML pages to fetch all post IDs."""
-        all_posts = []
-        post_found = False
-        page_number = 1
-        self.output("Collecting fanclub posts...\n")
-        while True:
-            response = self.session.get(FANCLUB_POSTS_HTML.format(fanclub.id, page_number))
-            response.raise_for_status()
-            response_page = BeautifulSoup(response.text, "html.parser")
-            posts = response_page.select("div.post")
-            new_post_ids = []
-            for post in posts:
-                link = post.select_one("a.link-block")["href"]
-                post_id = link.lstrip(POST_RELATIVE_URL)
-                date_string = post.select_one(".post-date .mr-5").text if post.select_one(".post-date .mr-5") else post.select_one(".post-date").text
-                parsed_date = dt.strptime(date_string, "%Y-%m-%d %H:%M")
-                if not self.month_limit or (parsed_date.year == self.month_limit.year and parsed_date.month == self.month_limit.month):
-                    post_found = True
-                    new_post_ids.append(post_id)
-            all_posts += new_post_ids
-            if not posts or (not new_post_ids and post_found): # No new posts found and we've already collected a post
-                self.output("Collected {} posts.\n".format(len(all_posts)))
-                return all_posts
-            else:
-                page_number += 1
+        queue_counts = self.db.count_queue()
+        self.output("Work queue: {} done, {} failed.\n".format(queue_counts.get("done", 0), queue_counts.get("failed", 0)))
 
-    def perform_download(self, url, filepath, use_server_filename=False, append_server_extension=False):
+    def perform_download(self, url, filepath, use_server_filename=False, append_server_extension=False, post_content_id=None):
         """Perform a download for the specified URL while showing progress."""
+        started = time.monotonic()
         url_path = unquote(url.split("?", 1)[0])
+        source_url_path = url_path
         server_filename = os.path.basename(url_path)
-        filename = os.path.basename(filepath)
         if use_server_filename:
             filepath = os.path.join(os.path.dirname(filepath), server_filename)
+        elif append_server_extension:
+            # Reuse the extension resolved on a previous run so the final filename is known up front
+            extension = self.db.find_url_extension(url_path)
+            if extension is not None:
+                filepath += extension
+                append_server_extension = False
+        filename = os.path.basename(filepath)
 
         # Check if filename is in exclusion list
         if server_filename in self.exclusions:
             self.output("Server filename in exclusion list (skipping): {}\n".format(server_filename))
+            self.metrics.record_skip("excluded")
             return
         elif filename in self.exclusions:
             self.output("Filename in exclusion list (skipping): {}\n".format(filename))
+            self.metrics.record_skip("excluded")
             return
 
         if self.db.conn and self.db.is_url_downloaded(url_path):
             self.output("URL already downloaded. Skipping...\n")
+            self.metrics.record_skip("database")
             return
 
-        request = self.session.get(url, stream=True)
+        # Trust the manifest of previous downloads unless asked to confirm against the server
+        manifest_entry = None if self.verify else self.manifest.find(source_url_path)
+        if manifest_entry:
+            manifest_filepath = os.path.join(self.directory, manifest_entry["path"])
+            if os.path.isfile(manifest_filepath) and os.stat(manifest_filepath).st_size == manifest_entry["size"]:
+                self.output("File found in manifest (skipping): {}\n".format(manifest_filepath))
+                self.metrics.record_skip("manifest")
+                return
+
+        request_headers = {}
+        if self.http_cache and os.path.isfile(filepath) and not (append_server_extension and not use_server_filename):
+            # Completed downloads carry the server's Last-Modified as their modification time
+            request_headers["If-Modified-Since"] = formatdate(os.stat(filepath).st_mtime, usegmt=True)
+
+        request = self.session.get(url, stream=True, headers=request_headers)
+        if request.status_code == 304:
+            if request.url == url:
+                self.output("File not modified (skipping): {}\n".format(filepath))
+                self.db.insert_url(url_path, self.relative_path(filepath), os.stat(filepath).st_size, post_content=post_content_id)
+                self.record_manifest(source_url_path, filepath, os.stat(filepath).st_size, request.headers.get("Last-Modified"))
+                self.metrics.record_skip("not_modified")
+                return
+            # The condition was checked against a different file than the one redirected to
+            request = self.session.get(url, stream=True)
         if request.status_code == 404:
             self.output("Download URL returned 404. Skipping...\n")
+            self.metrics.record_skip("not_found")
             return
         request.raise_for_status()
 
@@ -389,31 +881,48 @@ class FantiaDownloader:
             server_filename = os.path.basename(url_path)
             if server_filename in self.exclusions:
                 self.output("Server filename in exclusion list (skipping): {}\n".format(server_filename))
+                self.metrics.record_skip("excluded")
                 return
             if use_server_filename:
                 filepath = os.path.join(os.path.dirname(filepath), server_filename)
 
         if not use_server_filename and append_server_extension:
-            filepath += guess_extension(request.headers["Content-Type"], url)
+            extension = guess_extension(request.headers["Content-Type"], url)
+            self.db.insert_url_extension(source_url_path, extension)
+            filepath += extension
+            filename = os.path.basename(filepath)
+            if filename in self.exclusions:
+                self.output("Filename in exclusion list (skipping): {}\n".format(filename))
+                self.metrics.record_skip("excluded")
+                return
 
         file_size = int(request.headers["Content-Length"])
         if os.path.isfile(filepath) and os.stat(filepath).st_size == file_size:
             self.output("File found (skipping): {}\n".format(filepath))
-            self.db.insert_url(url_path)
+            self.db.insert_url(url_path, self.relative_path(filepath), file_size, post_content=post_content_id)
+            self.record_manifest(source_url_path, filepath, file_size, request.headers.get("Last-Modified"))
+            self.metrics.record_skip("file_exists")
             return
 
         self.output("File: {}\n".format(filepath))
         incomplete_filename = filepath + ".part"
-
-        downloaded = 0
-        with open(incomplete_filename, "wb") as file:
-            for chunk in request.iter_content(self.chunk_size):
-                downloaded += len(chunk)
-                file.write(chunk)
-                done = int(25 * downloaded / file_size)
-                percent = int(100 * downloaded / file_size)
-                self.output("\r|{0}{1}| {2}% ".format("\u2588" * done, " " * (25 - done), percent))
-        self.output("\n")
+        headers = request.headers
+        validator = {
+            "size": file_size,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")
+        }
+
+        downloaded = self.load_resume_offset(incomplete_filename, validator)
+        if not downloaded and self.segments > 1 and file_size >= self.segment_threshold and headers.get("Accept-Ranges") == "bytes":
+            request.close()
+            # Range requests go straight to the resolved media URL rather than through the API host's redirect
+            downloaded = self.perform_segmented_download(request.url, incomplete_filename, validator)
+            file_hash = hash_file(incomplete_filename)
+        else:
+            downloaded, file_hash = self.perform_stream_download(request, url, incomplete_filename, validator, downloaded)
+        if self.pool.jobs > 1:
+            self.output("Finished: {}\n".format(filepath))
 
         if downloaded != file_size:
             raise Exception("Downloaded file size mismatch (expected {}, got {})".format(file_size, downloaded))
@@ -421,51 +930,201 @@ class FantiaDownloader:
         if os.path.exists(filepath):
             os.remove(filepath)
         os.rename(incomplete_filename, filepath)
+        self.remove_resume_validator(incomplete_filename)
 
-        self.db.insert_url(url_path)
+        self.db.insert_url(url_path, self.relative_path(filepath), file_size, file_hash.hexdigest(), post_content_id)
+        self.metrics.record_download(downloaded, time.monotonic() - started)
+        self.record_manifest(source_url_path, filepath, file_size, headers.get("Last-Modified"))
 
-        modification_time_string = request.headers["Last-Modified"]
+        modification_time_string = headers["Last-Modified"]
         modification_time = int(dt.strptime(modification_time_string, "%a, %d %b %Y %H:%M:%S %Z").timestamp())
         if modification_time:
             access_time = int(time.time())
             os.utime(filepath, times=(access_time, modification_time))
 
-    def download_photo(self, photo_url, photo_counter, gallery_directory):
-        """Download a photo to the post's directory."""
-        extension = self.process_content_type(photo_url)
-        filename = os.path.join(gallery_directory, str(photo_counter) + extension) if gallery_directory else str()
-        self.perform_download(photo_url, filename, use_server_filename=self.use_server_filenames)
+        if self.content_store and self.content_store.add(filepath, file_hash.hexdigest(), file_size):
+            self.output("Linked duplicate content: {}\n".format(filepath))
+
+    def relative_path(self, filepath):
+        """Return a download's path relative to the output directory."""
+        return os.path.relpath(filepath, self.directory or ".")
+
+    def record_manifest(self, url_path, filepath, size, last_modified):
+        """Record a completed download in the manifest, relative to the output directory."""
+        self.manifest.record(url_path, self.relative_path(filepath), size, last_modified)
+
+    def perform_stream_download(self, request, url, incomplete_filename, validator, downloaded=0):
+        """Write a download to its partial file over a single connection, resuming from the given offset.
+        The file is checksummed from the chunks as they're written; only a resumed prefix is read back."""
+        if downloaded:
+            request.close()
+            request = self.request_range(url, downloaded, validator)
+            if request.status_code == 206:
+                self.output("Resuming download from {} bytes...\n".format(downloaded))
+            else:
+                self.output("Server did not accept the resume request. Restarting download...\n")
+                downloaded = 0
+        self.save_resume_validator(incomplete_filename, validator)
+        file_hash = hash_file(incomplete_filename, limit=downloaded) if downloaded else new_hash()
+
+        # Chunks only bump the transfer's counter; the progress renderer repaints on its own schedule
+        transfer = self.progress.start(os.path.basename(incomplete_filename[:-len(".part")]), validator["size"], downloaded)
+        attempts = 0
+        try:
+            with open(incomplete_filename, "ab" if downloaded else "wb") as file:
+                while True:
+                    try:
+                        for chunk in request.iter_content(self.chunk_size):
+                            downloaded += len(chunk)
+                            file.write(chunk)
+                            file_hash.update(chunk)
+                            transfer.add(len(chunk))
+                        break
+                    except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                        # Keep what was written so far and pick the transfer back up from the last written byte
+                        attempts += 1
+                        if attempts > RESUME_ATTEMPTS or downloaded >= validator["size"]:
+                            raise
+                        file.flush()
+                        self.output("Connection interrupted at {} bytes. Resuming...\n".format(downloaded))
+                        request = self.request_range(url, downloaded, validator)
+                        if request.status_code != 206:
+                            file.seek(0)
+                            file.truncate()
+                            downloaded = 0
+                            file_hash = new_hash()
+                            transfer.reset()
+        finally:
+            self.progress.finish(transfer)
+        return downloaded, file_hash
+
+    def perform_segmented_download(self, url, incomplete_filename, validator):
+        """Download byte ranges of a file in parallel into a preallocated partial file."""
+        file_size = validator["size"]
+        segment_size = math.ceil(file_size / self.segments)
+        with open(incomplete_filename, "wb") as file:
+            file.truncate(file_size)
+
+        self.output("Downloading in {} segments...\n".format(math.ceil(file_size / segment_size)))
+        transfer = self.progress.start(os.path.basename(incomplete_filename[:-len(".part")]), file_size)
+        try:
+            with ThreadPoolExecutor(max_workers=self.segments, thread_name_prefix="fantiadl-segment") as executor:
+                segments = [executor.submit(self.download_segment, url, incomplete_filename, start, min(start + segment_size, file_size) - 1, validator, transfer) for start in range(0, file_size, segment_size)]
+                self.pool.wait(segments)
+        finally:
+            self.progress.finish(transfer)
+        return sum(segment.result() for segment in segments)
+
+    def download_segment(self, url, incomplete_filename, start, end, validator, transfer):
+        """Download a single byte range into its position in the partial file."""
+        position = start
+        attempts = 0
+        with self.profiler.phase("transfer"), open(incomplete_filename, "r+b") as file:
+            file.seek(start)
+            while position <= end:
+                request = self.request_range(url, position, validator, end)
+                if request.status_code != 206:
+                    raise Exception("Server did not return the requested byte range {}-{}".format(position, end))
+                try:
+                    for chunk in request.iter_content(self.chunk_size):
+                        chunk = chunk[:end + 1 - position]
+                        file.write(chunk)
+                        position += len(chunk)
+                        transfer.add(len(chunk))
+                        if position > end:
+                            break
+                except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                    if attempts >= RESUME_ATTEMPTS:
+                        raise
+                finally:
+                    request.close()
+                # Request whatever is left of the range if the connection ended early
+                attempts += 1
+                if position <= end and attempts > RESUME_ATTEMPTS:
+                    break
+        return position - start
+
+    def load_resume_offset(self, incomplete_filename, validator):
+        """Return the number of bytes that can be resumed from an existing partial download."""
+        if not os.path.isfile(incomplete_filename):
+            return 0
+        try:
+            with open(incomplete_filename + ".json", "r") as file:
+                stored_validator = json.load(file)
+        except (OSError, ValueError):
+            return 0
+        # Only resume when the partial file was written for the same version of the remote file
+        if stored_validator.get("size") != validator["size"]:
+            return 0
+        if validator["etag"] and stored_validator.get("etag") != validator["etag"]:
+            return 0
+        if not validator["etag"] and stored_validator.get("last_modified") != validator["last_modified"]:
+            return 0
+        offset = os.stat(incomplete_filename).st_size
+        return offset if offset < validator["size"] else 0
+
+    def save_resume_validator(self, incomplete_filename, validator):
+        """Store the validators of the remote file alongside a partial download."""
+        with open(incomplete_filename + ".json", "w") as file:
+            json.dump(validator, file)
+
+    def remove_resume_validator(self, incomplete_filename):
+        """Remove the stored validators once a partial download is complete."""
+        if os.path.exists(incomplete_filename + ".json"):
+            os.remove(incomplete_filename + ".json")
+
+    def request_range(self, url, offset, validator, end=None):
+        """Request the remainder of a file (or up to an end offset) starting at the given byte offset."""
+        range_headers = {"Range": "bytes={}-{}".format(offset, "" if end is None else end)}
+        # Weak ETags can't be used with If-Range, so fall back to the modification date
+        if validator["etag"] and not validator["etag"].startswith("W/"):
+            range_headers["If-Range"] = validator["etag"]
+        elif validator["last_modified"]:
+            range_headers["If-Range"] = validator["last_modified"]
+        request = self.session.get(url, stream=True, headers=range_headers)
+        request.raise_for_status()
+        return request
+
+    def photo_download(self, photo_url, photo_counter, gallery_directory):
+        """Return the URL, path and filename options of a photo download to the post's directory."""
+        filename = os.path.join(gallery_directory, str(photo_counter)) if gallery_directory else str()
+        return photo_url, filename, self.use_server_filenames, True
 
-    def download_file(self, download_url, filename, post_directory):
-        """Download a file to the post's directory."""
-        self.perform_download(download_url, filename, use_server_filename=True) # Force serve filenames to prevent duplicate collision
+    def file_download(self, download_url, filename):
+        """Return the URL, path and filename options of a file download to the post's directory."""
+        return download_url, filename, True, False # Force serve filenames to prevent duplicate collision
 
-    def download_post_content(self, post_json, post_directory, post_title):
-        """Parse the post's content to determine whether to save the content as a photo gallery or file."""
+    def download_post_content(self, post_json, post_directory, post_title, queued_contents):
+        """Parse the post's content to determine whether to save the content as a photo gallery or file.
+        Queued downloads are appended to queued_contents along with the content, to be recorded once they finish."""
         self.output(f"> Content {post_json['id']}\n")
 
         if self.db.conn and self.db.is_post_content_downloaded(post_json["id"]):
             self.output("Post content already downloaded. Skipping...\n")
+            self.metrics.record_skip("post_content_downloaded")
             return True
 
         if post_json["visible_status"] != "visible":
             self.output("Post content not available on current plan. Skipping...\n")
             return False
 
+        parent_post = post_json["parent_post"]["url"].rsplit("/", 1)[1]
+        downloads = []
         if post_json.get("category"):
             if post_json["category"] == "photo_gallery":
                 photo_gallery = post_json["post_content_photos"]
                 photo_counter = 0
                 gallery_directory = os.path.join(post_directory, sanitize_for_path(post_title))
-                os.makedirs(gallery_directory, exist_ok=True)
+                if not self.plan:
+                    os.makedirs(gallery_directory, exist_ok=True)
                 for photo in photo_gallery:
                     photo_url = photo["url"]["original"]
-                    self.download_photo(photo_url, photo_counter, gallery_directory)
+                    downloads.append(self.photo_download(photo_url, photo_counter, gallery_directory))
                     photo_counter += 1
             elif post_json["category"] == "file":
                 filename = os.path.join(post_directory, post_json["filename"])
                 download_url = urljoin(POSTS_URL, post_json["download_uri"])
-                self.download_file(download_url, filename, post_directory)
+                downloads.append(self.file_download(download_url, filename))
             elif post_json["category"] == "embed":
                 if self.parse_for_external_links:
                     # TODO: Check what URLs are allowed as embeds
@@ -477,32 +1136,104 @@ class FantiaDownloader:
                 blog_json = json.loads(blog_comment)
                 photo_counter = 0
                 gallery_directory = os.path.join(post_directory, sanitize_for_path(post_title))
-                os.makedirs(gallery_directory, exist_ok=True)
+                if not self.plan:
+                    os.makedirs(gallery_directory, exist_ok=True)
                 for op in blog_json["ops"]:
                     if type(op["insert"]) is dict and op["insert"].get("fantiaImage"):
                         photo_url = urljoin(BASE_URL, op["insert"]["fantiaImage"]["original_url"])
-                        self.download_photo(photo_url, photo_counter, gallery_directory)
+                        downloads.append(self.photo_download(photo_url, photo_counter, gallery_directory))
                         photo_counter += 1
             else:
                 self.output("Post content category \"{}\" is not supported. Skipping...\n".format(post_json.get("category")))
                 return False
 
-        self.db.insert_post_content(post_json["id"], post_json["parent_post"]["url"].rsplit("/", 1)[1], post_json["title"], post_json["category"], post_json["foreign_plan_price"], post_json["currency_code"])
+        if not self.plan:
+            # Queue every download of the content before any of them starts, so --resume only completes the content once all are done
+            self.db.insert_queued_post_content(post_json["id"], parent_post, post_json["title"], post_json["category"], post_json["foreign_plan_price"], post_json["currency_code"])
+            for url, filepath, use_server_filename, append_server_extension in downloads:
+                self.db.enqueue_download(url, filepath, use_server_filename, append_server_extension, post_json["id"])
+        downloads = [self.queue_download(url, filepath, use_server_filename, append_server_extension, post_json["id"], parent_post, enqueued=True) for url, filepath, use_server_filename, append_server_extension in downloads]
 
         if self.parse_for_external_links:
             post_description = post_json["comment"] or ""
             self.parse_external_links(post_description, os.path.abspath(post_directory))
 
+        queued_contents.append((post_json, downloads))
         return True
 
-    def download_thumbnail(self, thumb_url, post_directory):
-        """Download a thumbnail to the post's directory."""
-        extension = self.process_content_type(thumb_url)
-        filename = os.path.join(post_directory, "thumb" + extension)
-        self.perform_download(thumb_url, filename, use_server_filename=self.use_server_filenames)
+    def record_post_contents(self, queued_contents):
+        """Wait for the downloads of every queued content, then record the contents whose downloads all succeeded."""
+        try:
+            self.pool.wait([future for _, downloads in queued_contents for future in downloads])
+        finally:
+            # Contents that finished are recorded even when another failed or the wait was interrupted
+            for post_json, downloads in queued_contents:
+                if self.plan or not all(future.done() and not future.cancelled() and future.exception() is None for future in downloads):
+                    continue
+                parent_post = post_json["parent_post"]["url"].rsplit("/", 1)[1]
+                self.db.insert_post_content(post_json["id"], parent_post, post_json["title"], post_json["category"], post_json["foreign_plan_price"], post_json["currency_code"])
+                self.db.delete_queued_post_content(post_json["id"])
+
+    def download_thumbnail(self, thumb_url, post_directory, post_id=None):
+        """Queue a thumbnail download to the post's directory."""
+        filename = os.path.join(post_directory, "thumb")
+        return self.queue_download(thumb_url, filename, use_server_filename=self.use_server_filenames, append_server_extension=True, post_id=post_id)
+
+    def fetch_csrf_token(self, post_id):
+        """Fetch a post's HTML page and cache the session's CSRF token from it."""
+        post_html_response = self.session.get(POST_URL.format(post_id))
+        post_html_response.raise_for_status()
+        csrf_token = find_csrf_token(post_html_response.text)
+        if not csrf_token:
+            raise Exception("Could not find CSRF token for post {}".format(post_id))
+        self.csrf_token = csrf_token
+        return csrf_token
+
+    def fetch_post_json(self, post_id):
+        """Fetch a post's metadata from the API, reusing the cached CSRF token until it's rejected."""
+        csrf_token = self.csrf_token
+        for attempt in range(2):
+            if csrf_token is None or attempt:
+                with self.csrf_lock:
+                    # Another thread may have refreshed the token while this one waited
+                    if self.csrf_token is None or self.csrf_token == csrf_token:
+                        self.fetch_csrf_token(post_id)
+                    csrf_token = self.csrf_token
+            response = self.fetch(POST_API.format(post_id), headers={
+                "X-CSRF-Token": csrf_token,
+                "X-Requested-With": "XMLHttpRequest"
+            })
+            if response.status_code in (401, 403, 422) and not attempt:
+                self.output("CSRF token rejected. Refreshing...\n")
+                continue
+            response.raise_for_status()
+            return json.loads(response.text)["post"]
 
     def download_post(self, post_id):
-        """Download a post to its own directory."""
+        """Download a post to its own directory, tracking its state in the work queue."""
+        if self.plan:
+            # Planning leaves the work queue to the run that downloads the plan
+            with self.profiler.phase("dispatch"):
+                self.perform_post_download(post_id)
+            self.handled_posts.add(int(post_id))
+            return
+        queue_key = str(post_id)
+        # Posts are queued as they're taken, not as they're crawled, since the crawl runs ahead of the limit
+        self.db.enqueue_post(post_id)
+        self.db.update_queue_state("post", queue_key, "in_progress")
+        try:
+            with self.profiler.phase("dispatch"):
+                self.perform_post_download(post_id)
+            self.db.update_queue_state("post", queue_key, "done")
+            self.handled_posts.add(int(post_id))
+        except Exception as error:
+            self.db.update_queue_state("post", queue_key, "failed", str(error))
+            raise
+        finally:
+            self.db.checkpoint()
+
+    def perform_post_download(self, post_id):
+        """Download a post's metadata and contents."""
         db_post = self.db.find_post(post_id)
         if self.db_bypass_post_check and self.db.conn and db_post and db_post["download_complete"]:
             self.output("Post {} already downloaded. Skipping...\n".format(post_id))
@@ -510,17 +1241,8 @@ class FantiaDownloader:
 
         self.output("Downloading post {}...\n".format(post_id))
 
-        post_html_response = self.session.get(POST_URL.format(post_id))
-        post_html_response.raise_for_status()
-        post_html = BeautifulSoup(post_html_response.text, "html.parser")
-        csrf_token = post_html.select_one("meta[name=\"csrf-token\"]")["content"]
-
-        response = self.session.get(POST_API.format(post_id), headers={
-            "X-CSRF-Token": csrf_token,
-            "X-Requested-With": "XMLHttpRequest"
-        })
-        response.raise_for_status()
-        post_json = json.loads(response.text)["post"]
+        with self.profiler.phase("post"):
+            post_json = self.fetch_post_json(post_id)
 
         post_id = post_json["id"]
         post_creator = post_json["fanclub"]["creator_name"]
@@ -534,42 +1256,53 @@ class FantiaDownloader:
             # Check if the post date changed, which may indicate new contents were added
             if db_post["converted_at"] != post_converted_at:
                 self.output("Post date does not match date in database. Checking for new contents...\n")
-                self.db.update_post_download_complete(post_id, download_complete=0)
-                self.db.update_post_converted_at(post_id, post_converted_at)
+                if not self.plan:
+                    self.db.update_post_download_complete(post_id, download_complete=0)
+                    self.db.update_post_converted_at(post_id, post_converted_at)
             else:
                 self.output("Post appears to have been downloaded completely. Skipping...\n".format(post_id))
                 return
-        if self.db.conn and not db_post:
+        # Planning only writes the plan; the database and directories are left to the run that downloads it
+        if self.db.conn and not db_post and not self.plan:
             self.db.insert_post(post_id, post_title, post_json["fanclub"]["id"], post_posted_at, post_converted_at)
 
         post_directory_title = sanitize_for_path(str(post_id))
 
         post_directory = os.path.join(self.directory, sanitize_for_path(post_creator), post_directory_title)
-        os.makedirs(post_directory, exist_ok=True)
+        if not self.plan:
+            os.makedirs(post_directory, exist_ok=True)
 
         post_titles = self.collect_post_titles(post_json)
 
-        if self.dump_metadata:
+        if self.dump_metadata and not self.plan:
             self.save_metadata(post_json, post_directory)
-        if self.mark_incomplete_posts:
+        if self.mark_incomplete_posts and not self.plan:
             self.mark_incomplete_post(post_json, post_directory)
+        thumbnail_downloads = []
         if self.download_thumb and post_json["thumb"]:
-            self.download_thumbnail(post_json["thumb"]["original"], post_directory)
+            thumbnail_downloads.append(self.download_thumbnail(post_json["thumb"]["original"], post_directory, post_id))
         if self.parse_for_external_links:
             # Main post
             post_description = post_json["comment"] or ""
             self.parse_external_links(post_description, os.path.abspath(post_directory))
 
         download_complete_counter = 0
-        for post_index, post in enumerate(post_contents):
-            post_title = post_titles[post_index]
-            if self.download_post_content(post, post_directory, post_title):
-                download_complete_counter += 1
-        if self.db.conn and download_complete_counter == len(post_contents):
+        queued_contents = []
+        try:
+            for post_index, post in enumerate(post_contents):
+                post_title = post_titles[post_index]
+                if self.download_post_content(post, post_directory, post_title, queued_contents):
+                    download_complete_counter += 1
+        finally:
+            # Wait once for the whole post, so one content's downloads don't hold up queuing the next's
+            self.record_post_contents(queued_contents)
+        if self.db.conn and not self.plan and download_complete_counter == len(post_contents):
             self.output("All post content appears to have been downloaded. Marking as complete in database...\n")
             self.db.update_post_download_complete(post_id)
 
-        if not os.listdir(post_directory):
+        self.pool.wait(thumbnail_downloads)
+
+        if not self.plan and not os.listdir(post_directory):
             self.output("No content downloaded for post {}. Deleting directory.\n".format(post_id))
             os.rmdir(post_directory)
 
@@ -616,6 +1349,14 @@ def guess_extension(mimetype, download_url):
             extension = ".unknown"
     return extension
 
+def find_csrf_token(html):
+    """Scan an HTML page for the content of its csrf-token meta tag without building a DOM."""
+    meta_match = CSRF_META_RE.search(html)
+    if not meta_match:
+        return None
+    content_match = CSRF_CONTENT_RE.search(meta_match.group(0))
+    return content_match.group(1) if content_match else None
+
 def sanitize_for_path(value, replace=' '):
     """Remove potentially illegal characters from a path."""
     sanitized = re.sub(r'[<>\"\?\\\/\*:|]', replace, value)
@@ -0,0 +1,92 @@
+from bs4 import BeautifulSoup
+from datetime import datetime as dt
+import re
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+POST_RELATIVE_URL = "/posts/"
+FANCLUB_RELATIVE_URL = "/fanclubs/"
+POST_DATE_FORMAT = "%Y-%m-%d %H:%M"
+POST_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})")
+
+
+def parse_post_date(date_string):
+    """Parse a listing date like 2024-01-31 12:00, skipping strptime's format handling for the usual zero-padded form."""
+    match = POST_DATE_RE.fullmatch(date_string)
+    if match:
+        return dt(*map(int, match.groups()))
+    return dt.strptime(date_string, POST_DATE_FORMAT)
+
+
+def has_class(name):
+    """XPath predicate matching elements with a CSS class, like the .name selector."""
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+class SoupParser:
+    """Parses listing pages with BeautifulSoup and the pure-Python html.parser."""
+    name = "html.parser"
+
+    def fanclub_posts(self, html):
+        """Return (post ID, posted date) pairs for the posts on a fanclub's posts page."""
+        response_page = BeautifulSoup(html, "html.parser")
+        posts = []
+        for post in response_page.select("div.post"):
+            link = post.select_one("a.link-block")["href"]
+            date_element = post.select_one(".post-date .mr-5") or post.select_one(".post-date")
+            posts.append((link.lstrip(POST_RELATIVE_URL), parse_post_date(date_element.text)))
+        return posts
+
+    def paid_fanclub_ids(self, html):
+        """Return the fanclub IDs listed on a paid plans page."""
+        response_page = BeautifulSoup(html, "html.parser")
+        fanclub_links = response_page.select("div.mb-5-children > div:nth-of-type(1) a[href^=\"/fanclubs\"]")
+        return [fanclub_link["href"].lstrip(FANCLUB_RELATIVE_URL) for fanclub_link in fanclub_links]
+
+
+class LxmlParser:
+    """Parses listing pages with lxml's C parser, querying the same elements as SoupParser with XPath."""
+    name = "lxml"
+
+    POSTS_XPATH = "//div[{}]".format(has_class("post"))
+    LINK_XPATH = "(.//a[{}])[1]/@href".format(has_class("link-block"))
+    DATE_XPATH = "(.//*[{}]//*[{}])[1]".format(has_class("post-date"), has_class("mr-5"))
+    DATE_FALLBACK_XPATH = "(.//*[{}])[1]".format(has_class("post-date"))
+    FANCLUB_LINKS_XPATH = "//div[{}]/div[1]//a[starts-with(@href, '/fanclubs')]/@href".format(has_class("mb-5-children"))
+
+    def parse(self, html):
+        if not html.strip():
+            return None
+        return lxml.html.document_fromstring(html)
+
+    def fanclub_posts(self, html):
+        response_page = self.parse(html)
+        if response_page is None:
+            return []
+        posts = []
+        for post in response_page.xpath(self.POSTS_XPATH):
+            link = post.xpath(self.LINK_XPATH)[0]
+            date_element = (post.xpath(self.DATE_XPATH) or post.xpath(self.DATE_FALLBACK_XPATH))[0]
+            posts.append((link.lstrip(POST_RELATIVE_URL), parse_post_date(date_element.text_content())))
+        return posts
+
+    def paid_fanclub_ids(self, html):
+        response_page = self.parse(html)
+        if response_page is None:
+            return []
+        return [href.lstrip(FANCLUB_RELATIVE_URL) for href in response_page.xpath(self.FANCLUB_LINKS_XPATH)]
+
+
+PARSERS = {SoupParser.name: SoupParser}
+if lxml is not None:
+    PARSERS[LxmlParser.name] = LxmlParser
+
+
+def get_parser(name=None):
+    """Return the named listing page parser, defaulting to lxml when it's installed."""
+    if name is None:
+        name = LxmlParser.name if LxmlParser.name in PARSERS else SoupParser.name
+    return PARSERS[name]()
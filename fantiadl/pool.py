@@ -0,0 +1,185 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import nullcontext
+from urllib.parse import urlparse
+import queue
+import threading
+
+
+class HostLimiter:
+    """Cap the number of concurrent transfers against a single host."""
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def slot(self, url):
+        """Return the semaphore guarding transfers for the URL's host."""
+        host = urlparse(url).hostname or ""
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+class DownloadPool:
+    """Bounded thread pool shared by all downloads over the course of a run."""
+    def __init__(self, jobs=1, per_host=0, limiter=None):
+        self.jobs = max(1, jobs)
+        self.hosts = HostLimiter(per_host or self.jobs)
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="fantiadl-download") if self.jobs > 1 else None
+        self.lock = threading.Lock()
+        self.queued = 0
+
+    def submit(self, url, function, *args, **kwargs):
+        """Schedule a download. Without worker threads the download runs immediately."""
+        if self.executor is None:
+            future = Future()
+            future.set_result(function(url, *args, **kwargs))
+            return future
+        with self.lock:
+            self.queued += 1
+        return self.executor.submit(self.run, url, function, *args, **kwargs)
+
+    def run(self, url, function, *args, **kwargs):
+        # Transfers hold an adaptive media slot for their whole duration, shrinking concurrency when throttled
+        with self.hosts.slot(url), self.limiter.slot() if self.limiter else nullcontext():
+            with self.lock:
+                self.queued -= 1
+            return function(url, *args, **kwargs)
+
+    def queue_depth(self):
+        """Return the number of downloads waiting for a worker or a free slot."""
+        return self.queued
+
+    def wait(self, futures):
+        """Wait for every future to finish, then raise the first error encountered."""
+        if not futures:
+            return
+        try:
+            wait(futures)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+        for future in futures:
+            exception = future.exception()
+            if exception is not None:
+                raise exception
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class Pipeline:
+    """Run a generator on a background thread, buffering at most `size` items ahead of the consumer."""
+    ITEM, ERROR, DONE, EMPTY = range(4)
+
+    def __init__(self, iterable, size):
+        self.queue = queue.Queue(maxsize=max(1, size))
+        self.stopped = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=self.produce, args=(iterable,), name="fantiadl-crawl", daemon=True)
+        self.thread.start()
+
+    def produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self.put(self.ITEM, item):
+                    break
+            else:
+                self.put(self.DONE, None)
+        except BaseException as exception:
+            self.put(self.ERROR, exception)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    def put(self, kind, value):
+        """Block until the consumer has room for the item, giving up once the pipeline is closed."""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put((kind, value), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == self.DONE:
+                return
+            elif kind == self.ERROR:
+                raise value
+            yield value
+
+    def poll(self, timeout=0):
+        """Return (Pipeline.ITEM, item), (Pipeline.EMPTY, None) if nothing arrived within the timeout, or (Pipeline.DONE, None)."""
+        if self.done:
+            return self.DONE, None
+        try:
+            kind, value = self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()
+        except queue.Empty:
+            return self.EMPTY, None
+        if kind == self.DONE:
+            self.done = True
+        elif kind == self.ERROR:
+            self.done = True
+            raise value
+        return kind, value
+
+    def close(self):
+        """Stop the producer, e.g. once the consumer has reached a limit."""
+        self.stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PagePrefetcher:
+    """Fetch numbered pages on background threads up to `window` pages ahead of the consumer, yielding them in page order.
+    Pages past `expected_pages` are only fetched once the consumer asks for them.
+    Closing the prefetcher, e.g. once a page ends the listing, cancels speculative fetches that haven't started."""
+    def __init__(self, fetch_page, window, expected_pages=None):
+        self.fetch_page = fetch_page
+        self.window = max(0, window)
+        self.expected_pages = expected_pages
+        self.next_page = 1
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.window + 1, thread_name_prefix="fantiadl-prefetch") if self.window else None
+
+    def schedule(self):
+        while len(self.pending) <= self.window:
+            if self.pending and self.expected_pages is not None and self.next_page > self.expected_pages:
+                break
+            self.pending.append(self.executor.submit(self.fetch_page, self.next_page))
+            self.next_page += 1
+
+    def __iter__(self):
+        while True:
+            if self.executor is None:
+                page = self.fetch_page(self.next_page)
+                self.next_page += 1
+            else:
+                self.schedule()
+                page = self.pending.popleft().result()
+            yield page
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,154 @@
+from contextlib import nullcontext
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+COLLAPSED_FILENAME = "profile.collapsed"
+
+NULL_PHASE = nullcontext()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Phase:
+    """Context manager attributing the current thread's work to a named phase."""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profiler.exit()
+
+
+class Profiler:
+    """Collects cProfile data per named phase on every thread, merged into one .pstats file per phase,
+    plus periodic stack samples of threads inside a phase, written as collapsed stacks for flame graphs.
+    Phases nest; work is attributed to the innermost one. When disabled, phases cost a single method call."""
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.enabled = directory is not None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+        self.active = {}
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self.run, name="fantiadl-profiler", daemon=True)
+            self.thread.start()
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def thread_state(self):
+        state = getattr(self.local, "state", None)
+        if state is None:
+            state = self.local.state = {"stack": [], "profiles": {}}
+            with self.lock:
+                self.active[threading.get_ident()] = state["stack"]
+        return state
+
+    def profile_for(self, state, name):
+        profile = state["profiles"].get(name)
+        if profile is None:
+            profile = state["profiles"][name] = cProfile.Profile()
+            with self.lock:
+                self.profiles.append((name, profile))
+        return profile
+
+    def enter(self, name):
+        state = self.thread_state()
+        stack = state["stack"]
+        if stack and stack[-1][0] == name:
+            stack.append(stack[-1])
+            return
+        if stack and stack[-1][1]:
+            self.profile_for(state, stack[-1][0]).disable()
+        stack.append((name, self.enable(self.profile_for(state, name))))
+
+    def exit(self):
+        state = self.thread_state()
+        stack = state["stack"]
+        name, profiling = stack.pop()
+        if stack and stack[-1][0] == name:
+            return
+        if profiling:
+            self.profile_for(state, name).disable()
+        if stack:
+            outer_name, _ = stack[-1]
+            stack[-1] = (outer_name, self.enable(self.profile_for(state, outer_name)))
+
+    def enable(self, profile):
+        """Start a profile, returning whether it could be started.
+        From Python 3.12 only one profile can be active at a time, so concurrent phases are left to the sampler."""
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        return True
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                active = list(self.active.items())
+            for ident, stack in active:
+                frame = frames.get(ident)
+                try:
+                    phase_name = stack[-1][0]
+                except IndexError:
+                    continue
+                if frame is None or ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                key = ";".join([phase_name] + labels[::-1])
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def close(self):
+        """Stop sampling and write the collected profiles, returning the paths written."""
+        if not self.enabled:
+            return []
+        self.stopped.set()
+        self.thread.join()
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        phases = {}
+        with self.lock:
+            for name, profile in self.profiles:
+                profile.disable()
+                phases.setdefault(name, []).append(profile)
+        for name, profiles in sorted(phases.items()):
+            stats = None
+            for profile in profiles:
+                try:
+                    stats = stats.add(profile) if stats else pstats.Stats(profile)
+                except TypeError:
+                    # The profile never ran, e.g. a phase that only overlapped others on Python 3.12+
+                    continue
+            if stats is None:
+                continue
+            path = os.path.join(self.directory, "{}.pstats".format(name))
+            stats.dump_stats(path)
+            paths.append(path)
+        path = os.path.join(self.directory, COLLAPSED_FILENAME)
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write("{} {}\n".format(stack, count))
+        paths.append(path)
+        return paths
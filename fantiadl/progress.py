@@ -0,0 +1,191 @@
+import os
+import shutil
+import sys
+import threading
+import time
+
+REPAINT_INTERVAL = 0.2 # seconds between repaints on a terminal
+LOG_INTERVAL = 30 # seconds between progress lines when output is redirected
+MAX_TRANSFER_LINES = 8
+RATE_SMOOTHING = 0.3
+BAR_WIDTH = 25
+NAME_WIDTH = 30
+
+
+def write_console(stream, text):
+    """Write text to a console stream, escaping characters its encoding can't represent."""
+    encoding = getattr(stream, "encoding", None) or "utf-8"
+    try:
+        stream.write(text.encode(encoding, errors="backslashreplace").decode(encoding))
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        stream.buffer.write(text.encode("utf-8"))
+    stream.flush()
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(int(size))
+        size /= 1024
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "{:02d}:{:02d}".format(seconds // 60, seconds % 60)
+
+
+class Transfer:
+    """Byte counter for a single active download."""
+    def __init__(self, progress, name, total, downloaded=0):
+        self.progress = progress
+        self.name = name
+        self.total = total
+        self.downloaded = downloaded
+        self.resumed = downloaded
+        self.started = time.monotonic()
+
+    def add(self, count):
+        with self.progress.lock:
+            self.downloaded += count
+            self.progress.transferred += count
+
+    def reset(self, downloaded=0):
+        """Restart the count after the server refused to resume."""
+        with self.progress.lock:
+            self.downloaded = downloaded
+            self.resumed = downloaded
+            self.started = time.monotonic()
+
+    def rate(self, now):
+        elapsed = now - self.started
+        return (self.downloaded - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+
+class ProgressRenderer:
+    """Tracks every active transfer and repaints their progress from a single background thread.
+    Downloads only bump counters; rendering happens at a fixed rate regardless of how many transfers are running.
+    When the stream isn't a terminal, a plain summary line is logged periodically instead."""
+    def __init__(self, stream=None, enabled=True, queue_depth=None):
+        self.stream = stream or sys.stdout
+        self.enabled = enabled
+        self.queue_depth = queue_depth
+        self.interactive = enabled and self.stream.isatty() and os.environ.get("TERM") != "dumb"
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.transfers = []
+        self.painted_lines = 0
+        self.transferred = 0
+        self.files = 0
+        self.started = time.monotonic()
+        self.last_sample = (self.started, 0)
+        self.smoothed_rate = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, name, total, downloaded=0):
+        """Register a new transfer and return its counter."""
+        transfer = Transfer(self, name, total, downloaded)
+        with self.lock:
+            self.transfers.append(transfer)
+        if self.enabled and self.thread is None:
+            with self.write_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="fantiadl-progress", daemon=True)
+                    self.thread.start()
+        return transfer
+
+    def finish(self, transfer):
+        with self.lock:
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+                if transfer.downloaded >= transfer.total:
+                    self.files += 1
+
+    def write(self, text):
+        """Write a message above the progress display."""
+        with self.write_lock:
+            self.clear()
+            write_console(self.stream, text)
+
+    def run(self):
+        interval = REPAINT_INTERVAL if self.interactive else LOG_INTERVAL
+        while not self.stopped.wait(interval):
+            self.sample()
+            with self.write_lock:
+                if self.interactive:
+                    self.repaint()
+                else:
+                    self.log()
+
+    def sample(self):
+        """Update the smoothed aggregate transfer rate."""
+        now = time.monotonic()
+        with self.lock:
+            transferred = self.transferred
+        last_time, last_transferred = self.last_sample
+        if now > last_time:
+            rate = (transferred - last_transferred) / (now - last_time)
+            self.smoothed_rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.smoothed_rate
+        self.last_sample = (now, transferred)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            transfers = [(transfer.name, transfer.downloaded, transfer.total, transfer.rate(now)) for transfer in self.transfers]
+        remaining = sum(max(0, total - downloaded) for _, downloaded, total, _ in transfers)
+        eta = remaining / self.smoothed_rate if self.smoothed_rate > 0 else None
+        queued = self.queue_depth() if self.queue_depth else 0
+        return transfers, eta, queued
+
+    def status_line(self, transfers, eta, queued):
+        return "{} active, {} queued | {}/s | ETA {}".format(len(transfers), queued, format_bytes(self.smoothed_rate), format_duration(eta))
+
+    def repaint(self):
+        transfers, eta, queued = self.snapshot()
+        width = max(40, shutil.get_terminal_size().columns - 1)
+        lines = []
+        for name, downloaded, total, rate in transfers[:MAX_TRANSFER_LINES]:
+            fraction = min(1.0, downloaded / total) if total else 0.0
+            done = int(BAR_WIDTH * fraction)
+            file_eta = (total - downloaded) / rate if rate > 0 else None
+            details = "|{}{}| {:3d}% {}/s ETA {}".format("█" * done, " " * (BAR_WIDTH - done), int(100 * fraction), format_bytes(rate), format_duration(file_eta))
+            lines.append("{:<{}} {}".format(name[:NAME_WIDTH], NAME_WIDTH, details)[:width])
+        if len(transfers) > MAX_TRANSFER_LINES:
+            lines.append("... and {} more".format(len(transfers) - MAX_TRANSFER_LINES))
+        if transfers or queued:
+            lines.append(self.status_line(transfers, eta, queued)[:width])
+        self.clear()
+        if lines:
+            write_console(self.stream, "\n".join(lines) + "\n")
+        self.painted_lines = len(lines)
+
+    def log(self):
+        transfers, eta, queued = self.snapshot()
+        if transfers:
+            downloaded = sum(transfer[1] for transfer in transfers)
+            total = sum(transfer[2] for transfer in transfers)
+            write_console(self.stream, "Progress: {}/{} | {}\n".format(format_bytes(downloaded), format_bytes(total), self.status_line(transfers, eta, queued)))
+
+    def clear(self):
+        """Erase the progress display so other output doesn't interleave with it."""
+        if self.painted_lines:
+            self.stream.write("\x1b[{}F\x1b[J".format(self.painted_lines))
+            self.painted_lines = 0
+
+    def close(self):
+        """Stop repainting and erase the progress display."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.write_lock:
+            self.clear()
+            self.stream.flush()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return "Downloaded {} files, {} at {}/s\n".format(self.files, format_bytes(self.transferred), format_bytes(self.transferred / elapsed if elapsed > 0 else 0))
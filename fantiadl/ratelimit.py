@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import threading
+import time
+
+from requests.adapters import HTTPAdapter, Retry
+
+# HTML pages and the JSON API are served from the main domain; everything else is treated as media (CDN)
+API_HOSTS = {"fantia.jp", "www.fantia.jp"}
+
+THROTTLE_STATUSES = {429, 500, 502, 503, 504, 507, 508}
+MIN_RATE = 0.2
+RATE_RECOVERY = 0.05 # fraction of the configured rate regained per successful request
+
+
+def host_class(host):
+    """Classify a host as serving the API/HTML pages or media."""
+    return "api" if host in API_HOSTS else "media"
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostClassLimiter:
+    """Token bucket and AIMD concurrency limit shared by every request to a class of hosts."""
+    def __init__(self, name, rate, max_concurrency, on_backoff=None):
+        self.name = name
+        self.max_rate = rate or None
+        self.rate = self.max_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.on_backoff = on_backoff
+        self.condition = threading.Condition()
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.backoffs = 0
+        self.started = time.monotonic()
+
+    def wait_for_token(self):
+        """Block until the class may send another request."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    self.condition.wait(self.blocked_until - now)
+                    continue
+                if self.rate is None:
+                    break
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                self.condition.wait((1 - self.tokens) / self.rate)
+            self.requests += 1
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the class's concurrent request slots."""
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def record(self, status_code, retry_after=None):
+        """Adjust limits from a response: back off multiplicatively when throttled, recover additively otherwise."""
+        throttled = status_code in THROTTLE_STATUSES
+        delay = None
+        with self.condition:
+            if throttled:
+                self.backoffs += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if self.rate is not None:
+                    self.rate = max(MIN_RATE, self.rate / 2)
+                delay = parse_retry_after(retry_after)
+                if delay:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                if self.rate is not None:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+            self.condition.notify_all()
+        if throttled and self.on_backoff:
+            self.on_backoff(self, status_code, delay)
+
+    def effective_rate(self):
+        """Return the average number of requests sent per second so far."""
+        elapsed = time.monotonic() - self.started
+        return self.requests / elapsed if elapsed > 0 else 0.0
+
+
+class RateLimiter:
+    """Per-host-class request scheduler shared by the whole session."""
+    def __init__(self, api_rate=4, api_concurrency=2, media_rate=0, media_concurrency=1, on_backoff=None):
+        self.classes = {
+            "api": HostClassLimiter("api", api_rate, api_concurrency, on_backoff),
+            "media": HostClassLimiter("media", media_rate, media_concurrency, on_backoff)
+        }
+
+    def for_host(self, host):
+        return self.classes[host_class(host)]
+
+    def for_url(self, url):
+        return self.for_host(urlparse(url).hostname or "")
+
+    def summary(self):
+        """Describe the effective request rate and backoff events of each host class."""
+        lines = []
+        for limiter in self.classes.values():
+            lines.append("{}: {} requests ({:.2f}/s), {} backoffs, concurrency {}{}\n".format(
+                limiter.name,
+                limiter.requests,
+                limiter.effective_rate(),
+                limiter.backoffs,
+                int(limiter.concurrency),
+                ", rate {:.2f}/s".format(limiter.rate) if limiter.rate is not None else ""
+            ))
+        return "".join(lines)
+
+
+class ThrottledRetry(Retry):
+    """Retry that reports every throttled attempt to the rate limiter, not only the final response."""
+    limiter = None
+    metrics = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.limiter = self.limiter
+        retry.metrics = self.metrics
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.limiter is not None and response is not None and _pool is not None:
+            self.limiter.for_host(_pool.host).record(response.status, response.headers.get("Retry-After"))
+        if self.metrics is not None and _pool is not None:
+            self.metrics.record_retry("{}://{}{}".format(_pool.scheme, _pool.host, url or ""))
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """HTTPAdapter that schedules requests through the rate limiter.
+    Streamed downloads hold their concurrency slot for the whole transfer in the download pool instead."""
+    def __init__(self, limiter, *args, metrics=None, **kwargs):
+        self.limiter = limiter
+        self.metrics = metrics
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        host_limiter = self.limiter.for_url(request.url)
+        waited = time.monotonic()
+        host_limiter.wait_for_token()
+        if stream:
+            started = time.monotonic()
+            response = super().send(request, stream=stream, **kwargs)
+        else:
+            with host_limiter.slot():
+                started = time.monotonic()
+                response = super().send(request, stream=stream, **kwargs)
+        host_limiter.record(response.status_code, response.headers.get("Retry-After"))
+        if self.metrics is not None:
+            self.metrics.record_wait(request.url, started - waited)
+            self.metrics.record_request(request.url, response.status_code, time.monotonic() - started, None if stream else len(response.content))
+        return response
@@ -0,0 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+
+VERIFY_CHUNK_SIZE = 1024 * 1024 * 8
+
+
+def new_hash():
+    """Create the hash used to checksum downloaded files."""
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path, chunk_size=VERIFY_CHUNK_SIZE, limit=None):
+    """Hash a file (or its first `limit` bytes) using large sequential reads."""
+    file_hash = new_hash()
+    remaining = limit
+    with open(path, "rb") as file:
+        while remaining is None or remaining > 0:
+            chunk = file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            file_hash.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return file_hash
+
+
+def check_file(path):
+    """Return the size and checksum of a file, or (None, None) if it's missing."""
+    try:
+        return os.stat(path).st_size, hash_file(path).hexdigest()
+    except FileNotFoundError:
+        return None, None
+
+
+def verify_archive(db, manifest, directory, jobs=None, repair=False, output=print, dedup_directory=None):
+    """Rehash every recorded download in parallel and report files that are missing or don't match.
+    When repairing, mismatched files are deleted and forgotten by the database and manifest so the next run fetches them again,
+    along with any corrupted blobs they were linked to in the deduplication store."""
+    rows = [row for row in db.fetch_downloaded_files() if row["path"]]
+    paths = [os.path.join(directory, row["path"]) for row in rows]
+    output("Verifying {} files...\n".format(len(rows)))
+
+    missing = []
+    mismatched = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        for row, path, (size, digest) in zip(rows, paths, executor.map(check_file, paths, chunksize=16)):
+            if size is None:
+                output("Missing: {}\n".format(path))
+                missing.append(row)
+            elif size != row["size"] or (row["hash"] and digest != row["hash"]):
+                output("Mismatch: {}\n".format(path))
+                mismatched.append(row)
+
+    output("Verified {} files: {} missing, {} mismatched.\n".format(len(rows), len(missing), len(mismatched)))
+    if repair and (missing or mismatched):
+        for row in mismatched:
+            os.remove(os.path.join(directory, row["path"]))
+        if dedup_directory:
+            remove_corrupt_blobs(dedup_directory, mismatched, output)
+        db.requeue_urls(row["url"] for row in missing + mismatched)
+        db.commit()
+        manifest.forget_paths(row["path"] for row in missing + mismatched)
+        output("Marked {} files for download on the next run.\n".format(len(missing) + len(mismatched)))
+    return not (missing or mismatched)
+
+
+def remove_corrupt_blobs(dedup_directory, rows, output=print):
+    """Delete the store blobs of mismatched files that no longer match their checksum, so fresh downloads aren't linked to them."""
+    from .dedup import blob_path, is_intact # dedup imports this module
+    for row in rows:
+        if not row["hash"]:
+            continue
+        path = blob_path(dedup_directory, row["hash"])
+        if os.path.isfile(path) and not is_intact(path, row["hash"], row["size"]):
+            os.remove(path)
+            output("Removed corrupt blob: {}\n".format(path))
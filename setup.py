@@ -30,6 +30,9 @@ setuptools.setup(
     ],
     license="MIT",
     install_requires=requirements,
+    extras_require={
+        "lxml": ["lxml"]
+    },
     entry_points={
         "console_scripts": [
             "fantiadl=fantiadl.fantiadl:cli"
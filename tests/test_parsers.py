@@ -0,0 +1,52 @@
+import os
+import unittest
+from datetime import datetime as dt
+
+from fantiadl import parsers
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def read_fixture(filename):
+    with open(os.path.join(FIXTURES_DIRECTORY, filename), encoding="utf-8") as file:
+        return file.read()
+
+
+class SoupParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = parsers.SoupParser()
+
+    def test_fanclub_posts(self):
+        self.assertEqual(self.parser.fanclub_posts(read_fixture("fanclub_posts.html")), [
+            ("2412345", dt(2024, 7, 28, 21, 0)),
+            ("2409876", dt(2024, 7, 21, 18, 30)),
+            ("2401111", dt(2024, 7, 15, 9, 5)),
+            ("2398765", dt(2024, 7, 1, 0, 0))
+        ])
+
+    def test_paid_fanclub_ids(self):
+        self.assertEqual(self.parser.paid_fanclub_ids(read_fixture("paid_plans.html")), ["10001", "10001", "20002", "30003", "30003"])
+
+
+@unittest.skipUnless(parsers.LxmlParser.name in parsers.PARSERS, "lxml is not installed")
+class LxmlParserTest(unittest.TestCase):
+    """The lxml backend must return exactly what html.parser does on real listing pages."""
+    def setUp(self):
+        self.parser = parsers.LxmlParser()
+        self.reference = parsers.SoupParser()
+
+    def test_fanclub_posts(self):
+        html = read_fixture("fanclub_posts.html")
+        self.assertEqual(self.parser.fanclub_posts(html), self.reference.fanclub_posts(html))
+
+    def test_paid_fanclub_ids(self):
+        html = read_fixture("paid_plans.html")
+        self.assertEqual(self.parser.paid_fanclub_ids(html), self.reference.paid_fanclub_ids(html))
+
+    def test_empty_page(self):
+        self.assertEqual(self.parser.fanclub_posts(""), self.reference.fanclub_posts(""))
+        self.assertEqual(self.parser.paid_fanclub_ids(""), self.reference.paid_fanclub_ids(""))
+
+
+if __name__ == "__main__":
+    unittest.main()